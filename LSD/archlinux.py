@@ -5,6 +5,12 @@ import os
 import sys
 import hashlib
 import time
+import multiprocessing
+import functools
+import itertools
+import collections
+import subprocess
+import json
 from Namcap import package as namcap
 import rethinkdb as r
 import requests
@@ -13,6 +19,187 @@ import progressbar
 
 from .table import Table
 from .gpg import GPG
+from .cache import Cache
+from .pkgbuild import parse_simple, parse_batch
+
+def hash_pkgbuild(pkgbuildpath):
+    """Calculate sha512 and sha256 of a PKGBUILD at the same time to speed it up"""
+    hash_sha512 = hashlib.sha512()
+    hash_sha256 = hashlib.sha256()
+    with open(pkgbuildpath, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_sha512.update(chunk)
+            hash_sha256.update(chunk)
+    return hash_sha512.hexdigest(), hash_sha256.hexdigest()
+
+def strip_package(pkg):
+    """Copy the known attributes of a namcap package into a plain dict"""
+    package = {}
+    for attribute in ArchLinux.attributes:
+        if attribute in pkg:
+            package[attribute] = pkg[attribute]
+    return package
+
+# Fields which namcap post-processes after parsepkgbuild.sh (version constraints, optdepends descriptions)
+namcap_fields = ['depends', 'makedepends', 'optdepends', 'conflicts', 'replaces', 'provides']
+
+def namcap_compatible(packages):
+    """Check if packages parsed without namcap are equal to the namcap output.
+    Plain package names are not changed by namcap, other entries of the post-processed
+    fields can only be parsed by namcap itself.
+    """
+    for pkg in packages:
+        for attribute in namcap_fields:
+            for value in pkg.get(attribute) or []:
+                if set(value) & set('<>=:'):
+                    return False
+    return True
+
+def load_pkgbuild_simple(pkgbuildpath):
+    """Parse a PKGBUILD without bash. Returns None if it is too complex for the simple parser."""
+    try:
+        with open(pkgbuildpath, "r", encoding='utf-8') as f:
+            packages = parse_simple(f.read())
+    except UnicodeDecodeError:
+        return None
+    if packages is None or not namcap_compatible(packages):
+        return None
+    return [strip_package(pkg) for pkg in packages]
+
+def load_pkgbuild(pkgbuildpath, fast=False, batch=False):
+    """Parse a PKGBUILD with namcap and return a list of its (split) packages as plain dicts.
+    Returns None for invalid PKGBUILDs. The dicts can be passed between processes.
+    With fast=True simple PKGBUILDs are parsed in python and only complex ones with namcap.
+    With batch=True a long-lived parsepkgbuild.sh worker is used and namcap only for
+    PKGBUILDs whose output namcap would post-process.
+    """
+    if fast:
+        packages = load_pkgbuild_simple(pkgbuildpath)
+        if packages is not None:
+            return packages
+
+    if batch:
+        packages = parse_batch(pkgbuildpath)
+        if packages is None:
+            return None
+        if namcap_compatible(packages):
+            return [strip_package(pkg) for pkg in packages]
+
+    pkginfo = namcap.load_from_pkgbuild(pkgbuildpath)
+    if pkginfo is None:
+        return None
+
+    packages = []
+    for pkg in (pkginfo.subpackages if pkginfo.is_split else [pkginfo]):
+        package = strip_package(pkg)
+
+        # Add package base information if available
+        if "base" in pkginfo:
+            package['base'] = pkginfo['base']
+        packages += [package]
+    return packages
+
+def compare_packages(parser, packages, namcap_packages):
+    """Returns a list of differing attributes between two parse results"""
+    packages = packages or []
+    namcap_packages = namcap_packages or []
+    differences = []
+    if len(packages) != len(namcap_packages):
+        differences += [(parser, 'packages', len(packages), len(namcap_packages))]
+    for pkg, namcap_pkg in zip(packages, namcap_packages):
+        for attribute in ArchLinux.attributes:
+            if pkg.get(attribute) != namcap_pkg.get(attribute):
+                differences += [(parser, attribute, pkg.get(attribute), namcap_pkg.get(attribute))]
+    return differences
+
+def compare_pkgbuild(pkgbuildpath):
+    """Parse a PKGBUILD with namcap, the simple parser and the batch worker and
+    return a list of differences. Also returns if the simple parser supports the PKGBUILD.
+    """
+    namcap_packages = load_pkgbuild(pkgbuildpath)
+    differences = compare_packages('batch', load_pkgbuild(pkgbuildpath, batch=True), namcap_packages)
+    simple_packages = load_pkgbuild_simple(pkgbuildpath)
+    if simple_packages is not None:
+        differences += compare_packages('simple', simple_packages, namcap_packages)
+    return pkgbuildpath, simple_packages is not None, differences
+
+def git_head(repo_path):
+    """Returns the current commit of a git repository or None"""
+    ret = subprocess.run(['git', '-C', repo_path, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if ret.returncode:
+        return None
+    return ret.stdout.decode('utf-8').strip()
+
+def git_changed_dirs(repo_path, old, new):
+    """Returns the set of top level directories changed between two commits.
+    Returns None if the diff failed, for example if the old commit is unknown.
+    """
+    ret = subprocess.run(['git', '-C', repo_path, 'diff', '--name-only', old, new], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if ret.returncode:
+        return None
+    lines = ret.stdout.decode('utf-8').splitlines()
+    return set(line.split('/', 1)[0] for line in lines if '/' in line and not line.startswith('.'))
+
+# Source url schemes grouped by transport security
+https_schemes = ('https', 'git+https', 'svn+https', 'hg+https', 'bzr+https')
+http_schemes = ('http', 'git+http', 'svn+http', 'git', 'svn', 'ftp', 'hg', 'bzr', 'hg+http', 'bzr+http', 'git+git')
+checksum_algos = ['md5sums', 'sha1sums', 'sha256sums', 'sha384sums', 'sha512sums', 'whirlpoolsums']
+
+def source_records(pkg):
+    """Split the 'name::url' source entries of a package into records with
+    filename, url, scheme (class), extension, signature flag and the matching checksums.
+    Stored at parse time so analyze does not need to parse the strings again.
+    """
+    records = []
+    for i, src in enumerate(pkg.get('source') or []):
+        name, separator, url = src.partition('::')
+        if not separator:
+            url = src
+        filename = os.path.basename(name)
+        extension = os.path.splitext(filename)[1]
+
+        if '://' not in url:
+            scheme = None
+            scheme_class = 'local'
+        else:
+            scheme = url.split('://', 1)[0]
+            if scheme in https_schemes:
+                scheme_class = 'https'
+            elif scheme in http_schemes:
+                scheme_class = 'http'
+            else:
+                scheme_class = 'unknown'
+
+        checksums = {}
+        for algo in checksum_algos:
+            if pkg.get(algo) and i < len(pkg[algo]):
+                checksums[algo] = pkg[algo][i]
+
+        records += [{
+            'filename': filename,
+            'url': url,
+            'scheme': scheme,
+            'scheme_class': scheme_class,
+            'extension': extension,
+            'signature': extension in GPG.signatures,
+            'checksums': checksums,
+        }]
+    return records
+
+# ArchLinux instance used by forked analyze workers
+_analyzer = None
+
+def _analyze_worker(batch, timestamp):
+    try:
+        pkgs = [pkg for pkg in batch if _analyzer.analyze_pkg(pkg, timestamp)]
+    except SystemExit as e:
+        return len(batch), [], {}, str(e)
+    pending = _analyzer.sources.pending
+    _analyzer.sources.pending = {}
+    return len(batch), pkgs, pending, None
+
+def _load_pkgbuild_worker(pkgbuild_param, fast=False, batch=False):
+    return pkgbuild_param, load_pkgbuild(pkgbuild_param[0], fast, batch)
 
 class ArchLinux(Table):
     """Manages 'archlinux' database. Inserts and updated packages."""
@@ -47,6 +234,7 @@ class ArchLinux(Table):
                 #'sha512',
                 #'sha256',
                 #'repository',
+                #'source_records',
                 # Security analysis:
                 # 'sec_gpg',
                 # 'sec_sig',
@@ -58,45 +246,96 @@ class ArchLinux(Table):
                 # 'timestamp'
                 ]
 
-    def __init__(self, conn, db, sources, force=False, clean=False, logger=None):
+    def __init__(self, conn, db, sources, force=False, clean=False, jobs=1, cache=None, fast=False, batch=False, yes=False, logger=None):
         super(ArchLinux, self).__init__(conn, db, 'archlinux', 'name', self.attributes, 'sha512')
         self.start()
         self.force = force
         self.sigurlcache = {}
         self.sources = sources
         self.clean = clean
+        self.jobs = jobs
+        self.cache = cache or Cache()
+        self.fast = fast
+        self.batch = batch
+        self.yes = yes
+        self.parsed = set()
+        self.failed = set()
+        self.gpgkeys = None
+        self.gpgratings = {}
+        self.known_hashes = None
         self.logger = logger or logging.getLogger(__name__)
 
-    def parse_pkgbuild(self, pkgbuildpath, pkgname, git_repo, pkg_repo):
-        # Calculate sha256 and sha512 of PKGBUILD at the same time to speed it up
-        hash_sha512 = hashlib.sha512()
-        hash_sha256 = hashlib.sha256()
-        with open(pkgbuildpath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha512.update(chunk)
-                hash_sha256.update(chunk)
-        sha512 = hash_sha512.hexdigest()
-        sha256 = hash_sha256.hexdigest()
+    def start(self, drop=False):
+        super(ArchLinux, self).start(drop)
+
+        # Reverse indexes to find the packages using a gpg key or source url
+        self.ensure_index('validgpgkeys', multi=True)
+        self.ensure_index('source_url', lambda pkg: pkg['source'].default([]).map(lambda src: src.split('::', 1)[-1]), multi=True)
+
+    def invalidate(self, fingerprints=None, urls=None):
+        """Mark the packages using changed gpg keys or sources for a new analysis.
+        The timestamp of those packages is removed, analyze skips all other packages.
+        """
+        table = r.db(self.db).table(self.table)
+        count = 0
+        for index, keys in (('validgpgkeys', fingerprints), ('source_url', urls)):
+            if not keys:
+                continue
+            ret = table.get_all(*keys, index=index).filter(lambda pkg: pkg.has_fields('timestamp')) \
+                    .replace(lambda pkg: pkg.without('timestamp'), durability='soft').run(self.conn)
+            count += ret['replaced']
+        if count:
+            print('Marked', count, 'packages for analysis')
+
+    def load_hashes(self):
+        """Load the sha512 of all parsed PKGBUILDs to avoid a query per PKGBUILD"""
+        self.known_hashes = set(r.db(self.db).table(self.table).distinct(index='sha512').run(self.conn))
+
+    def is_parsed(self, sha512):
+        """Check if a PKGBUILD with the given hash was already parsed"""
+        if self.known_hashes is None:
+            self.load_hashes()
+        return sha512 in self.known_hashes and not self.force
+
+    def cache_key(self, sha512):
+        """Cache key of a PKGBUILD, the results of every parser are cached separately"""
+        if self.fast and self.batch:
+            return 'simple+batch:' + sha512
+        elif self.fast:
+            return 'simple:' + sha512
+        elif self.batch:
+            return 'batch:' + sha512
+        return sha512
+
+    def parse_pkgbuild(self, pkgbuildpath, pkgname, git_repo, pkg_repo, writer):
+        sha512, sha256 = hash_pkgbuild(pkgbuildpath)
 
         # Check if package was already parsed with the given PKGBUILD
-        count = r.db(self.db).table(self.table).get_all(sha512, index='sha512').count().run()
-        if count > 0 and not self.force:
+        if self.is_parsed(sha512):
             self.logger.debug('Skipping %s', pkgname)
             return 0
 
         # Parse PKGBUILD information and expand data and packages information
-        pkginfo = namcap.load_from_pkgbuild(pkgbuildpath)
-        if pkginfo is None:
+        # Failed parses are not cached to retry them with the next parse
+        try:
+            packages = self.cache.get(self.cache_key(sha512))
+        except KeyError:
+            packages = None
+        if packages is None:
+            packages = load_pkgbuild(pkgbuildpath, self.fast, self.batch)
+            if packages is not None:
+                self.cache.set(self.cache_key(sha512), packages)
+        return self.insert_pkgbuild(sha512, sha256, packages, pkgbuildpath, pkgname, git_repo, pkg_repo, writer)
+
+    def insert_pkgbuild(self, sha512, sha256, packages, pkgbuildpath, pkgname, git_repo, pkg_repo, writer):
+        if packages is None:
             self.logger.error('%s is not a valid PKGBUILD', pkgbuildpath)
+            self.failed.add((git_repo, pkgname))
             return 0
 
         # Parse every (split) package
         count = 0
-        for pkg in (pkginfo.subpackages if pkginfo.is_split else [pkginfo]):
-            # Add package base information if available
-            if "base" in pkginfo:
-                pkg['base'] = pkginfo['base']
-
+        for pkg in packages:
             # Add package data
             if pkg['name'] not in pkg_repo:
                 self.logger.error('Unknown/outdated repository for package %s in PKGBUILD %s', pkg['name'], pkgname)
@@ -119,7 +358,8 @@ class ArchLinux(Table):
                     package[attribute] = pkg[attribute]
                 else:
                     package[attribute] = None
-            count = r.db(self.db).table(self.table).get_all(sha512, index='sha512').count().run()
+
+            package['source_records'] = source_records(package)
 
             # TODO fix for other distributions
             if git_repo == 'packages' and pkg_repo[pkg['name']] == 'community':
@@ -130,13 +370,86 @@ class ArchLinux(Table):
                 continue
             # TODO catch error where a package is in two PKGBUILDs in the same git repo(gconf-sharp, djview)
             # to fix this: Create a list of all parsed pkgnames and list duplicates
-            self.insert(package, replace=True)
+            writer.insert(package)
+            self.known_hashes.add(sha512)
+            self.parsed.add(package['name'])
             count += 1
 
         if not count:
             self.logger.error('No package found inside %s', pkgbuildpath)
         return count
 
+    def parse_parallel(self, pkgbuild_list, pkg_repo, bar, writer):
+        """Hash and load PKGBUILDs in a process pool.
+        Only the (slow) file hashing and namcap parsing is done by the workers,
+        all database reads and writes stay inside this process.
+        """
+        count = 0
+        done = 0
+        with multiprocessing.Pool(self.jobs) as pool:
+            # Hash all PKGBUILDs first and only load the changed ones
+            todo = []
+            pkgbuilds = [pkgbuild_param[0] for pkgbuild_param in pkgbuild_list]
+            hashes = pool.imap(hash_pkgbuild, pkgbuilds, chunksize=64)
+            for pkgbuild_param, (sha512, sha256) in zip(pkgbuild_list, hashes):
+                if self.is_parsed(sha512):
+                    self.logger.debug('Skipping %s', pkgbuild_param[1])
+                    done += 1
+                    bar.update(done)
+                    continue
+
+                # Use cached parse results if available
+                try:
+                    packages = self.cache.get(self.cache_key(sha512))
+                except KeyError:
+                    packages = None
+                if packages is None:
+                    todo += [pkgbuild_param + [sha512, sha256]]
+                    continue
+                count += self.insert_pkgbuild(sha512, sha256, packages, pkgbuild_param[0], pkgbuild_param[1], pkgbuild_param[2], pkg_repo, writer)
+                done += 1
+                bar.update(done)
+
+            # Load PKGBUILDs with namcap, results arrive in order of completion
+            worker = functools.partial(_load_pkgbuild_worker, fast=self.fast, batch=self.batch)
+            for pkgbuild_param, packages in pool.imap_unordered(worker, todo):
+                pkgbuild, package, repo, sha512, sha256 = pkgbuild_param
+                if packages is not None:
+                    self.cache.set(self.cache_key(sha512), packages)
+                count += self.insert_pkgbuild(sha512, sha256, packages, pkgbuild, package, repo, pkg_repo, writer)
+                done += 1
+                bar.update(done)
+        return count
+
+    def find_pkgbuild(self, repo_path, package):
+        """Returns the PKGBUILD path of a package directory or None if it does not exist"""
+        pkgbuild = repo_path + "/" + package + "/PKGBUILD"
+        if "/." in pkgbuild:
+            return None
+        if not os.path.exists(pkgbuild):
+            pkgbuild = repo_path + "/" + package + "/trunk/PKGBUILD"
+            if not os.path.exists(pkgbuild):
+                self.logger.error('PKGBUILD does not exist: %s', pkgbuild)
+                return None
+        return pkgbuild
+
+    def remove_pkgbuilds(self, git_repo, packages):
+        """Delete all (split) packages of removed PKGBUILD directories"""
+        for package in packages:
+            print('Removed PKGBUILD:', git_repo + '/' + package)
+
+        # Split packages are stored with the PKGBUILD directory as base
+        # TODO fix for other distributions
+        if git_repo == 'community':
+            query = r.db(self.db).table(self.table).filter({'repository': '[community]'})
+        elif git_repo == 'packages':
+            query = r.db(self.db).table(self.table).filter(r.row['repository'] != '[community]')
+        else:
+            query = r.db(self.db).table(self.table)
+        query = query.filter(lambda doc: r.expr(packages).contains(r.branch(doc['base'].default(None).ne(None), doc['base'], doc['name'])))
+        ret = query.delete().run(self.conn)
+        self.logger.info('Deleted %s packages of removed PKGBUILDs in %s', ret['deleted'], git_repo)
+
     def parse(self, path):
         # Read repositories from packages from local pkglist
         with open(os.path.join(path, 'archlinux/db/pkglist.txt'), "r") as pkglist:
@@ -148,61 +461,178 @@ class ArchLinux(Table):
             out = line.split(' ')
             pkg_repo[out[1]] = out[0]
 
+        # Load git commits and package list of the last parse
+        statefile = os.path.join(path, self.table + '/db/lastparse.json')
+        state = {'commits': {}, 'pkglist': {}, 'failed': {}}
+        if os.path.exists(statefile) and not self.force \
+                and not r.db(self.db).table(self.table).is_empty().run(self.conn):
+            with open(statefile, "r") as f:
+                state = json.load(f)
+
         # Parse PKGBUILD information into newpkg array
         # TODO print how many packages will get parsed
         # TODO print summary how many were inserted/updated/deleted
         print('Parsing PKGBUILD information')
         repositories = os.path.join(path, self.table + '/git')
         pkgbuild_list = []
+        commits = {}
         for repo in next(os.walk(repositories))[1]:
             repo_path = os.path.join(repositories, repo)
-            if "/." not in repo_path:
-                for package in next(os.walk(repo_path))[1]:
-                    pkgbuild = repo_path + "/" + package + "/PKGBUILD"
-                    if "/." not in pkgbuild:
-                        if not os.path.exists(pkgbuild):
-                            pkgbuild = repo_path + "/" + package + "/trunk/PKGBUILD"
-                            if not os.path.exists(pkgbuild):
-                                self.logger.error('PKGBUILD does not exist: %s', pkgbuild)
-                                continue
-                        pkgbuild_list += [[pkgbuild, package, repo, pkg_repo]]
+            if "/." in repo_path:
+                continue
+            commits[repo] = git_head(repo_path)
+
+            # Only parse PKGBUILDs changed since the last parse
+            packages = None
+            if repo in state['commits'] and commits[repo]:
+                packages = git_changed_dirs(repo_path, state['commits'][repo], commits[repo])
+            if packages is None:
+                packages = next(os.walk(repo_path))[1]
+            else:
+                # Also check packages that were added to or moved inside the repositories
+                for pkg in pkg_repo:
+                    if state['pkglist'].get(pkg) != pkg_repo[pkg] and os.path.isdir(os.path.join(repo_path, pkg)):
+                        packages.add(pkg)
+
+                # Retry PKGBUILDs which failed to parse, the failure may have been temporary
+                packages.update(state.get('failed', {}).get(repo, []))
+
+                # Remove packages of deleted PKGBUILDs
+                removed = [package for package in packages if not os.path.isdir(os.path.join(repo_path, package))]
+                if removed:
+                    self.remove_pkgbuilds(repo, removed)
+                packages = sorted(packages.difference(removed))
+                print('Found {} changed PKGBUILDs in {}'.format(len(packages), repo))
+
+            for package in packages:
+                pkgbuild = self.find_pkgbuild(repo_path, package)
+                if pkgbuild:
+                    pkgbuild_list += [[pkgbuild, package, repo]]
 
         # Parse PKGBUILDs
+        self.load_hashes()
         count = 0
-        with progressbar.ProgressBar(max_value=len(pkgbuild_list)) as bar:
-            for i, pkgbuild_param in enumerate(pkgbuild_list):
-                bar.update(i)
-                count += self.parse_pkgbuild(pkgbuild_param[0], pkgbuild_param[1], pkgbuild_param[2], pkgbuild_param[3])
+        with progressbar.ProgressBar(max_value=len(pkgbuild_list)) as bar, \
+                self.bulk(replace=True, durability='soft') as writer:
+            if self.jobs > 1:
+                count = self.parse_parallel(pkgbuild_list, pkg_repo, bar, writer)
+            else:
+                for i, pkgbuild_param in enumerate(pkgbuild_list):
+                    bar.update(i)
+                    count += self.parse_pkgbuild(pkgbuild_param[0], pkgbuild_param[1], pkgbuild_param[2], pkg_repo, writer)
         print('Inserted/Updated {} packages'.format(count))
+        self.cache.commit()
+
+        # Remember the parsed commits for the next incremental parse
+        failed = collections.defaultdict(list)
+        for repo, package in sorted(self.failed):
+            failed[repo] += [package]
+        state = {'commits': {repo: commit for repo, commit in commits.items() if commit}, 'pkglist': pkg_repo, 'failed': failed}
+        with open(statefile, "w") as f:
+            json.dump(state, f)
 
         # TODO print missing PKGBUILDs for packages in repositories
         # TODO find duplicated PKGBUILDs in "packages" and "community" git repository (moved packages)
 
         # Clean database from removed packages (to AUR)
         if self.clean:
-            pkglist = list(r.db(self.db).table(self.table)[self.pk].run(self.conn))
-            del_list = []
-            for pkg in pkglist:
-                if pkg not in pkg_repo:
-                    print('Clean:', pkg)
-                    del_list += [pkg]
-
-            if del_list:
-                # Ask the user to really clean
-                selection = input('Continue and clean selected packages? [y/N]')
-                if selection.lower() == 'y':
-                    # Clean
-                    for pkg in del_list:
-                        r.db(self.db).table(self.table).get(pkg).delete().run(self.conn)
-                else:
-                    print('Aborted clean')
+            self.reconcile(pkg_repo)
+
+    def reconcile(self, pkg_repo):
+        """Compare the database with the repository package list and delete stale packages"""
+        stored = set(r.db(self.db).table(self.table)[self.pk].run(self.conn))
+        available = set(pkg_repo)
+        added = self.parsed & available
+        removed = sorted(stored - available)
+        missing = sorted(available - stored)
+
+        for pkg in removed:
+            print('Clean:', pkg)
+        # Check for missing packages in LSD (unable to analyse with namcap probably)
+        for pkg in missing:
+            print('Missing package in LSD:', pkg)
+        print('Packages in repositories: {}, in LSD: {}, added/updated: {}, removed: {}, missing: {}'.format(
+            len(available), len(stored), len(added), len(removed), len(missing)))
+
+        if not removed:
+            print('Nothing to clean')
+            return
+
+        # Ask the user to really clean
+        if not self.yes:
+            selection = input('Continue and clean selected packages? [y/N]')
+            if selection.lower() != 'y':
+                print('Aborted clean')
+                return
+        ret = r.db(self.db).table(self.table).get_all(*removed).delete().run(self.conn)
+        print('Deleted {} packages'.format(ret['deleted']))
+
+    def compare_parsers(self, path):
+        """Parse all PKGBUILDs with namcap, the simple parser and the batch worker and print the differences"""
+        repositories = os.path.join(path, self.table + '/git')
+        pkgbuilds = []
+        for repo in next(os.walk(repositories))[1]:
+            repo_path = os.path.join(repositories, repo)
+            if "/." not in repo_path:
+                for package in next(os.walk(repo_path))[1]:
+                    pkgbuild = self.find_pkgbuild(repo_path, package)
+                    if pkgbuild:
+                        pkgbuilds += [pkgbuild]
+
+        print('Comparing parsers for {} PKGBUILDs'.format(len(pkgbuilds)))
+        supported = 0
+        different = 0
+        with progressbar.ProgressBar(max_value=len(pkgbuilds)) as bar, \
+                multiprocessing.Pool(self.jobs) as pool:
+            for i, (pkgbuild, simple, differences) in enumerate(pool.imap_unordered(compare_pkgbuild, pkgbuilds, chunksize=16)):
+                bar.update(i)
+                if simple:
+                    supported += 1
+                if differences:
+                    different += 1
+                for parser, attribute, value, namcap_value in differences:
+                    print('Difference in {} {}:'.format(pkgbuild, attribute))
+                    print('  {}: {}'.format(parser, value))
+                    print('  namcap: {}'.format(namcap_value))
+        print('{} of {} PKGBUILDs supported by the simple parser, {} with differences'.format(supported, len(pkgbuilds), different))
+
+    def load_gpgkeys(self):
+        """Load the GPG key information required for the rating into memory"""
+        cursor = r.db(self.db).table('gpg').pluck('fingerprint', 'expires', 'algo', 'length').run(self.conn)
+        self.gpgkeys = {gpgkey['fingerprint']: gpgkey for gpgkey in cursor}
+        self.gpgratings = {}
+
+    def rate_gpgkey(self, fingerprint, timestamp):
+        """Rate a single GPG key. Every key is only rated once per run."""
+        if fingerprint in self.gpgratings:
+            return self.gpgratings[fingerprint]
+        if self.gpgkeys is None:
+            self.load_gpgkeys()
+
+        # TODO use GPG class and import missing keys
+        gpgkey = self.gpgkeys.get(fingerprint)
+        if gpgkey is None:
+            sys.exit('Error: Fingerprint not in database: ' + fingerprint)
+
+        # Check expire date
+        ret = 'MID'
+        if gpgkey['expires'] != '' and timestamp > int(gpgkey['expires']):
+            self.logger.warn('Key expired: %s', fingerprint)
+        elif gpgkey['algo'] in GPG.secure_algos:
+            if int(gpgkey['length']) >= 4096:
+                ret = 'EXCELLENT'
+            elif int(gpgkey['length']) >= 2048:
+                ret = 'HIGH'
+        elif gpgkey['algo'] in GPG.secure_ecc_algos:
+            if int(gpgkey['length']) == 256:
+                ret = 'EXCELLENT'
             else:
-                print('Nothing to clean')
+                sys.exit('Error: Unkown algorithm type: ' + gpgkey['algo'] + ' for fingerprint ' + fingerprint)
+        elif gpgkey['algo'] not in GPG.insecure_algos:
+            sys.exit('Error: Unkown algorithm type: ' + gpgkey['algo'] + ' for fingerprint ' + fingerprint)
 
-            # Check for missing packages in LSD (unable to analyse with namcap probably)
-            for pkg in pkg_repo:
-                if pkg not in pkglist:
-                    print('Missing package in LSD:', pkg)
+        self.gpgratings[fingerprint] = ret
+        return ret
 
     def analyze_gpg(self, validgpgkeys):
         ret = 'NA'
@@ -215,57 +645,35 @@ class ArchLinux(Table):
 
             # Rate the worst of all GPG keys
             for fingerprint in validgpgkeys:
-                # TODO use GPG class and import missing keys
-                gpgkey = r.db(self.db).table('gpg').get(fingerprint).run()
-                if gpgkey is None:
-                    sys.exit('Error: Fingerprint not in database: ' + fingerprint)
-
-                # Check expire date
-                if gpgkey['expires'] != '' and timestamp > int(gpgkey['expires']):
-                    self.logger.warn('Key expired: %s', fingerprint)
-                    return 'MID'
-
-                if gpgkey['algo'] in GPG.secure_algos:
-                    if int(gpgkey['length']) >= 4096:
-                        continue
-                    elif int(gpgkey['length']) >= 2048:
-                        ret = 'HIGH'
-                        continue
-                elif gpgkey['algo'] in GPG.secure_ecc_algos:
-                    if int(gpgkey['length']) == 256:
-                        continue
-                    else:
-                        sys.exit('Error: Unkown algorithm type: ' + gpgkey['algo'] + ' for fingerprint ' + fingerprint)
-                elif gpgkey['algo'] not in GPG.insecure_algos:
-                    sys.exit('Error: Unkown algorithm type: ' + gpgkey['algo'] + ' for fingerprint ' + fingerprint)
+                rating = self.rate_gpgkey(fingerprint, timestamp)
 
-                # Stop on insecure algorithms
-                return 'MID'
+                # Stop on insecure keys
+                if rating == 'MID':
+                    return 'MID'
+                elif rating == 'HIGH':
+                    ret = 'HIGH'
 
             # Return whether the key is HIGH or EXCELLENT
             return ret
         else:
             return 'LOW'
 
-    def analyze_hash(self, pkg):
+    def analyze_hash(self, pkg, records):
         # Check hash security
         for hash_algo in ['sha512sums', 'whirlpoolsums', 'sha256sums', 'sha384sums', 'md5sums', 'sha1sums']:
             if pkg[hash_algo]:
-                for i, messagedigest in enumerate(pkg[hash_algo]):
-                    if messagedigest == 'SKIP':
-                        try:
-                            url = pkg['source'][i].split('::', 1)[-1]
-                        except IndexError:
-                            # TODO Some packages are parsed wrong (libreoffice-fresh-i18n)
-                            self.logger.error('Package %s has no valid url for hash', pkg['name'])
-                            return 'NA'
-                        filename = os.path.basename(pkg['source'][i].split('::', 1)[0])
-
+                for record in records:
+                    if record['checksums'].get(hash_algo) == 'SKIP':
                         # Only check for online archives
-                        if (url.startswith('https://') or url.startswith('http://') or url.startswith('ftp://')) and not url.endswith(tuple(GPG.signatures)):
-                            self.logger.error('Package %s has SKIP message digest for archive file %s', pkg['name'], filename)
+                        if record['scheme'] in ('https', 'http', 'ftp') and not record['url'].endswith(tuple(GPG.signatures)):
+                            self.logger.error('Package %s has SKIP message digest for archive file %s', pkg['name'], record['filename'])
                             return 'LOW'
 
+                # TODO Some packages are parsed wrong (libreoffice-fresh-i18n)
+                if 'SKIP' in pkg[hash_algo][len(records):]:
+                    self.logger.error('Package %s has no valid url for hash', pkg['name'])
+                    return 'NA'
+
         # Check hash algorithm used
         if pkg['sha512sums'] or pkg['whirlpoolsums']:
             return 'EXCELLENT'
@@ -278,17 +686,21 @@ class ArchLinux(Table):
         else:
             sys.exit('Error: Unknown hash used')
 
-    def analyze_sig(self, source, filenames, sec_gpg, avail_sigs):
+    def analyze_sig(self, records, sec_gpg, avail_sigs):
+        # Map filenames to their first source
+        filenames = {}
+        for record in records:
+            filenames.setdefault(record['filename'], record)
+
         # Parse sources for existant signatures
         sig_count = 0
         file_count = 0
-        for src in source:
-            filename = os.path.basename(src.split('::', 1)[0])
-            url = src.split('::', 1)[-1]
-            extension = os.path.splitext(filename)[1]
+        for record in records:
+            filename = record['filename']
+            url = record['url']
 
             # Skip signatures and exclude local files
-            if extension in GPG.signatures:
+            if record['signature']:
                 if '://' in url:
                     sig_count += 1
                     # TODO verify signature hash algorithm
@@ -301,15 +713,13 @@ class ArchLinux(Table):
             # Check for used signatures
             sig_avail = False
             for sig in GPG.signatures:
-                try:
-                    index = filenames.index(filename + sig)
-                except ValueError:
+                if filename + sig not in filenames:
                     continue
 
                 # Safe new found url + sig pair
                 sig_avail = True
                 if '://' in url:
-                    self.sources.set_sig(url, source[index].split('::', 1)[-1])
+                    self.sources.set_sig(url, filenames[filename + sig]['url'])
                 break
 
             # Lookup possible missing source signature in table
@@ -329,17 +739,15 @@ class ArchLinux(Table):
         else:
             return 'MID'
 
-    def analyze_https(self, source, upstream_url, avail_https):
+    def analyze_https(self, records, upstream_url, avail_https):
         # Check urls for https
         https_count = 0
-        for src in source:
-            url = src.split('::', 1)[-1]
-            if url.startswith('https://') or url.startswith('git+https://') \
-                    or url.startswith('svn+https://') or url.startswith('hg+https://') \
-                    or url.startswith('bzr+https://'):
+        for record in records:
+            url = record['url']
+            if record['scheme_class'] == 'https':
 
                 # Check http redirect
-                if url.startswith('https://'):
+                if record['scheme'] == 'https':
                     https_url = self.sources.get_https(url)
                     if https_url and https_url.startswith('http://'):
                         self.logger.warn('Insecure https -> http redirect %s', url)
@@ -347,23 +755,18 @@ class ArchLinux(Table):
                     # If the URL is None, the webserver refuses head downloads or it does not exist
                     # anymore. Keep calm and dont throw errors.
                 https_count += 1
-            elif url.startswith('http://') or url.startswith('git+http://') \
-                    or url.startswith('svn+http://') or url.startswith('git://') \
-                    or url.startswith('svn://') or url.startswith('ftp://') \
-                    or url.startswith('hg://') or url.startswith('bzr://') \
-                    or url.startswith('hg+http://') or url.startswith('bzr+http://') \
-                    or url.startswith('git+git://'):
+            elif record['scheme_class'] == 'http':
                 https_url = self.sources.get_https(url)
                 if https_url:
                     avail_https += [https_url]
-            elif '://' in url:
+            elif record['scheme_class'] == 'unknown':
                 sys.exit('Error: Unknown source protocol: ' + url)
             else:
                 # Local file
                 https_count += 1
 
         # Compute security status of https sources
-        if https_count == len(source):
+        if https_count == len(records):
             if upstream_url.startswith('https://'):
                 return 'EXCELLENT'
             else:
@@ -373,6 +776,9 @@ class ArchLinux(Table):
         else:
             return 'MID'
 
+    # Package fields read by analyze_pkg
+    analyze_fields = ['name', 'url', 'source', 'source_records', 'validgpgkeys', 'timestamp'] + checksum_algos
+
     def analyze_pkg(self, pkg, timestamp):
         pkgname = pkg['name']
         #print(pkg)
@@ -395,25 +801,22 @@ class ArchLinux(Table):
 
         # Check if sources are available
         if pkg['source']:
-            # Check hash security
-            pkg['sec_hash'] = self.analyze_hash(pkg)
+            # Packages parsed by older versions have no source records yet
+            if not pkg.get('source_records'):
+                pkg['source_records'] = source_records(pkg)
+            records = pkg['source_records']
 
-            # Create filename array
-            filenames = []
-            local_count = 0
-            for src in pkg['source']:
-                filenames += [os.path.basename(src.split('::', 1)[0])]
-                if '://' not in src:
-                    local_count += 1
+            # Check hash security
+            pkg['sec_hash'] = self.analyze_hash(pkg, records)
 
             # Skip https and signature check for local only PKGBUILDS
-            if local_count < len(pkg['source']):
+            if any(record['scheme'] for record in records):
                 # Check gpg key security
                 pkg['sec_gpg'] = self.analyze_gpg(pkg['validgpgkeys'])
 
                 # Parse sources for existant signatures
                 avail_sigs = []
-                pkg['sec_sig'] = self.analyze_sig(pkg['source'], filenames, pkg['sec_gpg'], avail_sigs)
+                pkg['sec_sig'] = self.analyze_sig(records, pkg['sec_gpg'], avail_sigs)
                 if avail_sigs:
                     pkg['avail_sigs'] = avail_sigs
                 else:
@@ -421,7 +824,7 @@ class ArchLinux(Table):
 
                 # Check urls for https
                 avail_https = []
-                pkg['sec_https'] = self.analyze_https(pkg['source'], pkg['url'], avail_https)
+                pkg['sec_https'] = self.analyze_https(records, pkg['url'], avail_https)
                 if avail_https:
                     pkg['avail_https'] = avail_https
                 else:
@@ -455,58 +858,151 @@ class ArchLinux(Table):
         return True
 
     def analyze(self, packages=None):
+        query = r.db(self.db).table(self.table)
         if packages:
-            cursor = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc['name'])).run()
-            count = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc['name'])).count().run()
-        else:
-            cursor = r.db(self.db).table(self.table).run()
-            count = r.db(self.db).table(self.table).count().run()
+            query = query.get_all(*packages)
+
+        # Only transfer packages which were not analyzed yet and only the fields read by the analyzers
+        if not self.force:
+            query = query.filter(lambda pkg: ~pkg.has_fields('timestamp'))
+        count = query.count().run(self.conn)
+        cursor = query.pluck(self.analyze_fields).run(self.conn)
+
+        # Check if new packages exist
+        if count == 0:
+            self.logger.info('All packages already analyzed. Force with -f.')
+            return
 
         timestamp = int(time.time()) # TODO
+        self.load_gpgkeys()
 
         # Analyze all packages
-        with progressbar.ProgressBar(max_value=count) as bar:
-            for i, pkg in enumerate(cursor):
-                bar.update(i)
-
-                # Insert new packages into database
-                if self.analyze_pkg(pkg, timestamp):
-                    self.insert(pkg, update=True)
+        with progressbar.ProgressBar(max_value=count) as bar, \
+                self.bulk(update=True, durability='soft') as writer:
+            if self.jobs > 1:
+                self.analyze_parallel(cursor, timestamp, bar, writer)
+                return
+
+            i = 0
+            while True:
+                batch = list(itertools.islice(cursor, 200))
+                if not batch:
+                    break
+
+                # Load all sources of the batch at once
+                urls = [record['url'] for pkg in batch for record in (pkg.get('source_records') or source_records(pkg)) if record['scheme']]
+                self.sources.prefetch(urls)
+
+                for pkg in batch:
+                    bar.update(i)
+                    i += 1
+
+                    # Insert new packages into database
+                    if self.analyze_pkg(pkg, timestamp):
+                        writer.insert(pkg)
+                self.sources.flush()
+
+    def analyze_parallel(self, cursor, timestamp, bar, writer):
+        """Analyze packages in a process pool.
+        The gpg keys and all sources are loaded before the pool is forked,
+        so the workers analyze from this read-only snapshot without database access.
+        Reading the cursor and writing the results stays inside this process.
+        """
+        global _analyzer
+        _analyzer = self
+        self.sources.load_all()
+
+        done = 0
+        results = collections.deque()
+        with multiprocessing.get_context('fork').Pool(self.jobs) as pool:
+            batches = iter(lambda: list(itertools.islice(cursor, 200)), [])
+            for batch in itertools.chain(batches, [None]):
+                if batch is not None:
+                    results.append(pool.apply_async(_analyze_worker, (batch, timestamp)))
+
+                # Collect finished batches, keep a few batches queued for every worker
+                while results and (batch is None or len(results) > 2 * self.jobs):
+                    count, pkgs, pending, error = results.popleft().get()
+                    if error:
+                        sys.exit(error)
+                    for pkg in pkgs:
+                        writer.insert(pkg)
+                    for url, sig in pending.items():
+                        self.sources.set_sig(url, sig)
+                    done += count
+                    bar.update(done)
+        self.sources.flush()
 
     def evaluate(self, packages=None):
-        data = {}
-
-        # Query security data
+        """Collect the security statistics of all (or the given) packages in a single pass over the table.
+        The result equals the former grouped queries: Groups are sorted like rethinkdb sorts them,
+        packages without a field are not grouped and null values count as missing for the available lists.
+        """
+        query = r.db(self.db).table(self.table)
+        if packages:
+            query = query.get_all(*set(packages))
         criteria = ['security', 'sec_gpg', 'sec_sig', 'sec_https', 'sec_hash']
-        repos = list(r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True)['repository'].distinct().run(self.conn))
+        cursor = query.pluck(['name', 'repository', 'avail_sigs', 'avail_https'] + criteria).run(self.conn)
+
+        # Count security data in groups
+        total = 0
+        counts = {crit: {} for crit in criteria}
+        repo_counts = {}
+        avail = {'avail_sigs': {}, 'avail_https': {}}
+        avail_total = {'avail_sigs': 0, 'avail_https': 0}
+        for pkg in cursor:
+            total += 1
+            has_repo = 'repository' in pkg
+            repo = pkg.get('repository')
+            if has_repo:
+                repo_counts.setdefault(repo, {crit: {} for crit in criteria})
+                repo_counts[repo]['count'] = repo_counts[repo].get('count', 0) + 1
+
+            for crit in criteria:
+                if crit in pkg:
+                    counts[crit][pkg[crit]] = counts[crit].get(pkg[crit], 0) + 1
+                    if has_repo:
+                        repo_counts[repo][crit][pkg[crit]] = repo_counts[repo][crit].get(pkg[crit], 0) + 1
+
+            # Lists of available signatures and https
+            for key in avail:
+                if pkg.get(key) is not None:
+                    avail_total[key] += 1
+                    if has_repo:
+                        avail[key].setdefault(repo, []).append({'name': pkg['name'], key: pkg[key]})
+
+        def order(values):
+            # rethinkdb sorts null before other values
+            return sorted(values, key=lambda value: (value is not None, value))
+
+        def grouped(groups):
+            return {key: groups[key] for key in order(groups)}
+
         data = {}
+        repos = order(repo_counts)
         for crit in criteria:
             data[crit] = {}
-            ret = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).group(crit).count().run(self.conn)
-            data[crit]['Total'] = ret
+            data[crit]['Total'] = grouped(counts[crit])
             for repo in repos:
-                ret = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).filter({'repository': repo}).group(crit).count().run(self.conn)
-                data[crit][repo] = ret
+                data[crit][repo] = grouped(repo_counts[repo][crit])
 
         # TODO Generate lists for security status of packages
 
         # Add package count
         data['count'] = {}
-        data['count']['Total'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).count().run(self.conn)
-        data['count'].update(r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).group('repository').count().run(self.conn))
-        data['repositories'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True)['repository'].distinct().run(self.conn)
+        data['count']['Total'] = total
+        data['count'].update({repo: repo_counts[repo]['count'] for repo in repos})
+        data['repositories'] = repos
 
         # Count available signatures and https
-        data['avail_sigs'] = {}
-        data['avail_sigs']['Total'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_sigs').count().run(self.conn)
-        data['avail_sigs'].update(r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_sigs').group('repository').count().run(self.conn))
-        data['avail_https'] = {}
-        data['avail_https']['Total'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_https').count().run(self.conn)
-        data['avail_https'].update(r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_https').group('repository').count().run(self.conn))
+        for key in avail:
+            data[key] = {}
+            data[key]['Total'] = avail_total[key]
+            data[key].update({repo: len(avail[key][repo]) for repo in order(avail[key])})
 
         # Get list of available signatures and https
-        data['avail_sigs_list'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_sigs').group('repository').pluck('name', 'avail_sigs').run(self.conn)
-        data['avail_https_list'] = r.db(self.db).table(self.table).filter(lambda doc: r.expr(packages).contains(doc["name"]) if packages else True).has_fields('avail_https').group('repository').pluck('name', 'avail_https').run(self.conn)
+        data['avail_sigs_list'] = grouped(avail['avail_sigs'])
+        data['avail_https_list'] = grouped(avail['avail_https'])
 
         return data
 
@@ -516,16 +1012,18 @@ class ArchLinux(Table):
         return keys
 
     def get_sources(self):
-        # Get all urls (remove name prefix and doubled entries)
-        cursor = r.db(self.db).table(self.table).has_fields('source').concat_map(lambda x: x['source'].map(lambda y: y.split('::')[-1])).distinct().run()
+        """Yield all remote source urls of all packages.
+        The urls are streamed from the cursor and may contain duplicates.
+        """
+        # Remove the name prefix. Use the source records and split the source strings of packages parsed by older versions.
+        cursor = r.db(self.db).table(self.table).has_fields('source').concat_map(lambda x: r.branch(x.has_fields('source_records'),
+                x['source_records'].filter(lambda y: y['scheme'].ne(None))['url'],
+                x['source'].map(lambda y: y.split('::')[-1]))).run(self.conn)
 
         # Filter local files out
-        sources = []
         for source in cursor:
             if '://' in source:
-                sources += [source]
-
-        return sources
+                yield source
 
     def get_urls(self):
         pass # TODO upstream urls
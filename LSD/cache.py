@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import os
+import time
+import json
+import zlib
+import sqlite3
+import logging
+
+class Cache(object):
+    """Persistent key value cache stored in a local sqlite database.
+    Values are stored as zlib compressed JSON. Entries older than max_age seconds
+    are evicted, then the least recently used entries until the cache fits max_size bytes.
+    Without path the cache only lives in memory.
+    """
+    def __init__(self, path=None, max_size=256 * 1024 * 1024, max_age=90 * 24 * 3600, version=1, logger=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.version = version
+        self.logger = logger or logging.getLogger(__name__)
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path or ':memory:')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, version INTEGER, '
+                'time INTEGER, atime INTEGER, size INTEGER, value BLOB)')
+
+    def get(self, key):
+        """Returns the cached value or raises KeyError"""
+        row = self.db.execute('SELECT value, time FROM cache WHERE key = ? AND version = ?', (key, self.version)).fetchone()
+        now = int(time.time())
+        if row is None or now - row[1] > self.max_age:
+            raise KeyError(key)
+        self.db.execute('UPDATE cache SET atime = ? WHERE key = ?', (now, key))
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def set(self, key, value):
+        data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        now = int(time.time())
+        self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                (key, self.version, now, now, len(data), data))
+
+    def evict(self):
+        """Remove outdated entries and shrink the cache to its maximum size"""
+        ret = self.db.execute('DELETE FROM cache WHERE time < ? OR version != ?', (int(time.time()) - self.max_age, self.version))
+        evicted = ret.rowcount
+
+        # Keep the most recently used entries
+        size = 0
+        old_keys = []
+        for key, entry_size in self.db.execute('SELECT key, size FROM cache ORDER BY atime DESC'):
+            size += entry_size
+            if size > self.max_size:
+                old_keys += [(key,)]
+        self.db.executemany('DELETE FROM cache WHERE key = ?', old_keys)
+        evicted += len(old_keys)
+
+        if evicted:
+            self.logger.info('Evicted %s entries from cache %s', evicted, self.path)
+
+    def commit(self):
+        self.evict()
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -3,8 +3,14 @@
 from __future__ import print_function
 import os
 import sys
+import json
+import hashlib
+import tarfile
+import functools
+import multiprocessing.pool
 import rethinkdb as r
 import gnupg
+import progressbar
 from .table import Table
 
 class GPG(Table):
@@ -44,72 +50,199 @@ class GPG(Table):
     insecure_algos = ['17']
     signatures = ['.sig', '.sign', '.asc']
 
-    def __init__(self, conn, db, keyserver, gnupghome=None, force=False):
+    def __init__(self, conn, db, keyserver, gnupghome=None, force=False, fallback_keyservers=None, jobs=4, batch_size=50):
         super(GPG, self).__init__(conn, db, 'gpg', 'fingerprint', self.attributes)
         self.start()
         self.keyserver = keyserver
+        self.fallback_keyservers = fallback_keyservers or []
+        self.jobs = jobs
+        self.batch_size = batch_size
         self.force = force
+        self.changed = set()
         self.gpg = gnupg.GPG(gnupghome=gnupghome)
+        self.gnupghome = gnupghome or os.environ.get('GNUPGHOME', os.path.expanduser('~/.gnupg'))
+        self.statefile = os.path.join(self.gnupghome, 'lsd_sync.json')
 
     def verboseprint(self, *args):
         # TODO if
         print(*args)
 
+    def keyring_stamp(self):
+        """Size and modification time of the keyring files to detect changes without running gpg.
+        GnuPG 2.4 stores the keys of new homedirs with keyboxd in public-keys.d.
+        """
+        stamp = {}
+        for name in ['pubring.kbx', 'pubring.gpg', 'public-keys.d/pubring.db', 'public-keys.d/pubring.db-wal']:
+            path = os.path.join(self.gnupghome, name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stamp[name] = [stat.st_size, stat.st_mtime_ns]
+        return stamp
+
+    def keyring_unchanged(self, state):
+        """Check if the keyring files did not change since the state was saved.
+        Without any known keyring file changes cannot be detected.
+        """
+        return bool(state.get('stamp')) and state['stamp'] == self.keyring_stamp()
+
+    def load_state(self):
+        """Returns the keyring stamp and key digests of the last sync"""
+        try:
+            with open(self.statefile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, digests):
+        with open(self.statefile, 'w') as f:
+            json.dump({'stamp': self.keyring_stamp(), 'digests': digests}, f)
+
+    def digest(self, key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def strip_key(self, key):
+        # Strip only required information
+        stripped_key = {}
+        for attribute in self.attributes:
+            if attribute in key:
+                stripped_key[attribute] = key[attribute]
+            else:
+                stripped_key[attribute] = None
+        return stripped_key
+
+    def keyring_fingerprints(self):
+        """Fingerprints of the local keyring. Uses the last sync if the keyring did not change."""
+        state = self.load_state()
+        if self.keyring_unchanged(state):
+            return set(state['digests'])
+        return set(key['fingerprint'] for key in self.gpg.list_keys())
+
+    def recv_batch(self, keyserver, keys):
+        """Download multiple keys with a single gpg call. Returns the imported fingerprints."""
+        # TODO sometimes thread errors appear here
+        # https://github.com/vsajip/python-gnupg/commit/a03cbd06543200377153983172237e6e476423e4#commitcomment-22398676
+        import_result = self.gpg.recv_keys(keyserver, *keys)
+        return set(fingerprint.upper() for fingerprint in import_result.fingerprints if fingerprint)
+
     def recv_keys(self, new_keys):
         # Only import new GPG keys
-        public_keys = self.gpg.list_keys()
-        for key in public_keys:
-            if key['fingerprint'] in new_keys:
-                new_keys.remove(key['fingerprint'])
-
-        # Import keys from keyserver
-        print('Importing', len(new_keys), 'GPG keys.')
-        for i, key in enumerate(new_keys, start=1):
-            # Download key from keyserver if not existant
-            # TODO sometimes thread errors appear here
-            # https://github.com/vsajip/python-gnupg/commit/a03cbd06543200377153983172237e6e476423e4#commitcomment-22398676
-            # TODO try 2nd keyserver on error
-            self.verboseprint('Importing', str(i) + '/' + str(len(new_keys)), key)
-            import_result = self.gpg.recv_keys(self.keyserver, key)
-
-            # Check if import was sucessful
-            if import_result.count != 1:
-                print('Error importing key', key)
-                # TODO exit here?
+        available = self.keyring_fingerprints()
+        missing = sorted(set(key.upper() for key in new_keys) - available)
+
+        # Import keys from keyservers in batches with a pool of concurrent gpg calls
+        # Keys which failed are retried with the fallback keyservers
+        print('Importing', len(missing), 'GPG keys.')
+        imported = 0
+        for keyserver in [self.keyserver] + self.fallback_keyservers:
+            if not missing:
+                break
+            self.verboseprint('Importing', len(missing), 'GPG keys from', keyserver)
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            fingerprints = set()
+            with multiprocessing.pool.ThreadPool(self.jobs) as pool, \
+                    progressbar.ProgressBar(max_value=len(missing)) as bar:
+                done = 0
+                for batch, result in zip(batches, pool.imap(functools.partial(self.recv_batch, keyserver), batches)):
+                    fingerprints |= result
+                    done += len(batch)
+                    bar.update(done)
+            imported += len(fingerprints & set(missing))
+            missing = [key for key in missing if key not in fingerprints]
+
+        # Summary
+        print('Imported', imported, 'GPG keys.')
+        if missing:
+            print('Error importing', len(missing), 'GPG keys:')
+            for key in missing:
+                print(key)
+            # TODO exit here?
+
+    def read_keys(self, path):
+        """Read armored keys and exported binary keyrings from a directory, a tarball or a single file.
+        Returns the concatenated armored and binary key data.
+        """
+        files = []
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for name in sorted(names):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        files += [(name, f.read())]
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                for member in tar:
+                    if member.isfile():
+                        files += [(member.name, tar.extractfile(member).read())]
+        else:
+            with open(path, 'rb') as f:
+                files += [(path, f.read())]
+
+        armored = []
+        binary = []
+        for name, data in files:
+            if b'-----BEGIN PGP PUBLIC KEY BLOCK-----' in data:
+                armored += [data]
+            elif name.endswith(('.gpg', '.pgp', '.key')):
+                binary += [data]
+            else:
+                self.verboseprint('Skipping', name)
+        return b'\n'.join(armored), b''.join(binary)
+
+    def import_keys(self, path):
+        """Import all keys of a directory, tarball or exported keyring without a keyserver"""
+        if not os.path.exists(path):
+            sys.exit('Error: Key path does not exist ' + path)
+
+        # One gpg call for all armored keys and one for all binary keyrings
+        count = 0
+        unchanged = 0
+        for data in self.read_keys(path):
+            if not data:
+                continue
+            result = self.gpg.import_keys(data)
+            count += result.count
+            unchanged += result.unchanged
+        print('Imported', count, 'GPG keys from', path + ',', unchanged, 'unchanged.')
 
     def sync_keys(self):
-        """Update rethinkdb gpg table with local GPG keys."""
+        """Update rethinkdb gpg table with local GPG keys.
+        Only keys which were added or changed since the last sync are written.
+        """
         # TODO --force update keyring data from keyserver information (takes very long)
-        public_keys = self.gpg.list_keys()
+        table = r.db(self.db).table(self.table)
+        fingerprints = set(table[self.pk].run(self.conn))
+        state = self.load_state()
+        known = state.get('digests')
 
-        fingerprints = r.db(self.db).table(self.table).pluck(self.pk).map(lambda x: x[self.pk]).distinct().run(self.conn)
+        # Skip the sync if the keyring files did not change
+        if not self.force and known is not None and self.keyring_unchanged(state) \
+                and set(known) == fingerprints:
+            print('GPG keyring unchanged since the last sync.')
+            return
+
+        # Without (matching) state compare against the keys in the table
+        if self.force:
+            known = {}
+        elif known is None or not set(known) <= fingerprints:
+            known = {key[self.pk]: self.digest(key) for key in table.pluck(self.attributes).run(self.conn)}
+
+        public_keys = self.gpg.list_keys()
         print('Attempting to update', len(public_keys), 'GPG keys in rethinkdb.')
-        for key in public_keys:
-            # Skip existing keys
-            if key['fingerprint'] in fingerprints and not self.force:
-                print('Skipping', key['fingerprint'])
-                continue
+        digests = {}
+        with self.bulk(replace=True) as writer:
+            for key in public_keys:
+                stripped_key = self.strip_key(key)
+                digest = self.digest(stripped_key)
+                digests[stripped_key[self.pk]] = digest
 
-            # Strip only required information
-            stripped_key = {}
-            for attribute in self.attributes:
-                if attribute in key:
-                    stripped_key[attribute] = key[attribute]
-                else:
-                    stripped_key[attribute] = None
-
-            # Insert/update key
-            ret = r.db(self.db).table(self.table).insert(stripped_key, conflict='replace').run()
-
-            # Print insert status
-            if ret['inserted']:
-                self.verboseprint('Inserted', stripped_key[self.pk])
-            elif ret['replaced']:
-                self.verboseprint('Replaced', stripped_key[self.pk])
-            elif ret['unchanged']:
-                self.verboseprint('Unchanged', stripped_key[self.pk])
-            else:
-                sys.exit('Error: unknown database information')
+                # Skip unchanged keys
+                if known.get(stripped_key[self.pk]) == digest and stripped_key[self.pk] in fingerprints:
+                    continue
+
+                # Insert/update key and remember changed keys to invalidate the packages using them
+                self.verboseprint('Updating', stripped_key[self.pk])
+                writer.insert(stripped_key)
+                self.changed.add(stripped_key[self.pk])
+        self.save_state(digests)
 
     def evaluate(self, keys=None):
         ret = r.db(self.db).table(self.table).filter(lambda doc: r.expr(keys).contains(doc['fingerprint']) if keys else True).group('algo', 'length').count().ungroup().order_by('group').run(self.conn)
@@ -11,6 +11,7 @@ from .archlinux import ArchLinux
 from .gpg import GPG
 from .lsa import LSA
 from .sources import Sources
+from .cache import Cache
 
 # TODO class server (for upstream urls without direct source)
 # url domain name between https:// and the next /
@@ -100,19 +101,31 @@ class LSD(object):
     version = '0.1'
     avail_tables = ['archlinux', 'gpg', 'sources', 'software'] # TODO refer to class variables
 
-    def __init__(self, force=None, clean=None, path='.', output='.', gnupghome=None):
+    def __init__(self, force=None, clean=None, path='.', output='.', gnupghome=None, jobs=1, cache_size=256, cache_age=90, fast_parse=False, batch_parse=False, yes=False, probe_limit=64, probe_per_host=4, probe_ttl=7, probe_negative_ttl=1, probe_persist_hosts=False, probe_budget=None):
         # Default: Parse all tables
         if force == []:
             self.force = self.avail_tables
-        elif not force:
-            self.force = []
+        else:
+            self.force = force or []
         if clean == []:
             self.clean = self.avail_tables
-        elif not clean:
-            self.clean = []
+        else:
+            self.clean = clean or []
         self.path = path
         self.output = output
         self.gnupghome = gnupghome
+        self.jobs = jobs
+        self.cache_size = cache_size
+        self.cache_age = cache_age
+        self.fast_parse = fast_parse
+        self.batch_parse = batch_parse
+        self.yes = yes
+        self.probe_limit = probe_limit
+        self.probe_per_host = probe_per_host
+        self.probe_ttl = probe_ttl
+        self.probe_negative_ttl = probe_negative_ttl
+        self.probe_persist_hosts = probe_persist_hosts
+        self.probe_budget = probe_budget
 
         # Check workdir and output pathe existance
         if not os.path.isdir(self.path):
@@ -129,7 +142,7 @@ class LSD(object):
             else:
                 sys.exit('Aborted by user')
 
-    def startdb(self, drop=[], keyserver='hkps://pgp.mit.edu'):
+    def startdb(self, drop=[], keyserver='hkps://pgp.mit.edu', fallback_keyservers=None):
         """Connects to rethinkdb and creates non-existing databases and tables.
         Database can be force-dropped via parameter.
         """
@@ -150,11 +163,20 @@ class LSD(object):
             print("Creating database", self.db)
             r.db_create(self.db).run()
 
-        self.sources = Sources(self.conn, self.db, force=('sources' in self.force))
+        # Cache http probe results of source urls in the workdir
+        probe_cache = Cache(os.path.join(self.path, 'sources/probe.cache'))
+        self.sources = Sources(self.conn, self.db, force=('sources' in self.force), probe_limit=self.probe_limit, probe_per_host=self.probe_per_host,
+                probe_cache=probe_cache, probe_ttl=self.probe_ttl * 24 * 3600, probe_negative_ttl=self.probe_negative_ttl * 24 * 3600,
+                probe_persist_hosts=self.probe_persist_hosts, probe_budget=self.probe_budget)
         self.sources.start(drop=(self.sources.table in drop))
-        self.archlinux = ArchLinux(self.conn, self.db, self.sources, force=('archlinux' in self.force), clean=('archlinux' in self.clean))
+        # Cache parse results of PKGBUILDs in the workdir
+        # Version 1 entries may contain simple parser results under the namcap key
+        cache = Cache(os.path.join(self.path, 'archlinux/db/pkgbuild.cache'), max_size=self.cache_size * 1024 * 1024, max_age=self.cache_age * 24 * 3600, version=2)
+        self.archlinux = ArchLinux(self.conn, self.db, self.sources, force=('archlinux' in self.force), clean=('archlinux' in self.clean), jobs=self.jobs, cache=cache, fast=self.fast_parse, batch=self.batch_parse, yes=self.yes)
         self.archlinux.start(drop=(self.archlinux.table in drop))
-        self.gpgtable = GPG(self.conn, self.db, keyserver, gnupghome=self.gnupghome, force=('gpg' in self.force))
+        # Downloading keys is network bound, use at least 4 concurrent gpg calls
+        self.gpgtable = GPG(self.conn, self.db, keyserver, gnupghome=self.gnupghome, force=('gpg' in self.force),
+                fallback_keyservers=fallback_keyservers, jobs=max(self.jobs, 4))
         self.gpgtable.start(drop=(self.gpgtable.table in drop))
 
     def parse(self, tables=None):
@@ -170,11 +192,21 @@ class LSD(object):
             keys = self.archlinux.get_gpgkeys()
             self.gpgtable.recv_keys(keys)
             self.gpgtable.sync_keys()
+            self.archlinux.invalidate(fingerprints=self.gpgtable.changed)
 
         if self.sources.table in tables:
             sources = self.archlinux.get_sources()
             self.sources.parse(sources)
 
+    def import_keys(self, path):
+        # Import GPG keys without keyserver and update the GPG keys database
+        self.gpgtable.import_keys(path)
+        self.gpgtable.sync_keys()
+        self.archlinux.invalidate(fingerprints=self.gpgtable.changed)
+
+    def compare_parsers(self):
+        self.archlinux.compare_parsers(self.path)
+
     def analyze(self, tables=None):
         # Default: Parse all tables
         if not tables:
@@ -182,6 +214,7 @@ class LSD(object):
 
         if self.sources.table in tables:
             self.sources.analyze()
+            self.archlinux.invalidate(urls=self.sources.changed)
 
         if self.archlinux.table in tables:
             self.archlinux.analyze()
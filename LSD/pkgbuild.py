@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import os
+import re
+import secrets
+import subprocess
+
+# Restricted PKGBUILD parser
+# Most PKGBUILDs only contain static variable assignments and functions which are not
+# executed by parsepkgbuild.sh. Those files can be parsed without starting bash.
+# Everything that is not fully understood raises Unsupported so the caller can fall back
+# to namcap. The output mimics parsepkgbuild.sh for non-split packages.
+
+class Unsupported(Exception):
+    pass
+
+# parsepkgbuild.sh output: (variable, key, type)
+# scalar: First element printed via echo -e
+# words: for i in ${array[@]} (word splitting of every element)
+# lines: for i in "${array[@]}"; echo $i (one line per element)
+fields = [
+    ('pkgdesc', 'desc', 'scalar'),
+    ('groups', 'groups', 'words'),
+    ('url', 'url', 'scalar'),
+    ('license', 'license', 'words'),
+    ('arch', 'arch', 'words'),
+    ('replaces', 'replaces', 'lines'),
+    ('depends', 'depends', 'lines'),
+    ('makedepends', 'makedepends', 'lines'),
+    ('optdepends', 'optdepends', 'lines'),
+    ('conflicts', 'conflicts', 'lines'),
+    ('provides', 'provides', 'lines'),
+    ('backup', 'backup', 'lines'),
+    ('options', 'options', 'lines'),
+    ('source', 'source', 'lines'),
+    ('validpgpkeys', 'validgpgkeys', 'lines'),
+    ('md5sums', 'md5sums', 'lines'),
+    ('sha1sums', 'sha1sums', 'lines'),
+    ('sha256sums', 'sha256sums', 'lines'),
+    ('sha384sums', 'sha384sums', 'lines'),
+    ('sha512sums', 'sha512sums', 'lines'),
+    ('install', 'install', 'scalar'),
+]
+
+re_assignment = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)(\+?=)')
+re_function = re.compile(r'(function[ \t]+)?[A-Za-z_][A-Za-z0-9_.+-]*[ \t]*\(\)[ \t\n]*\{[ \t]*\n')
+re_name = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+glob_chars = set('*?[')
+ifs_chars = set(' \t\n')
+
+class SimpleParser(object):
+    """Parses top level variable assignments of a PKGBUILD without executing it"""
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.variables = {}
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.text):
+            return self.text[self.pos + offset]
+        return ''
+
+    def skip_blanks(self, newlines=False):
+        while True:
+            c = self.peek()
+            if c and (c in ' \t' or (newlines and c == '\n')):
+                self.pos += 1
+            elif c == '\\' and self.peek(1) == '\n':
+                self.pos += 2
+            elif c == '#' and newlines:
+                self.skip_comment()
+            else:
+                return
+
+    def skip_comment(self):
+        end = self.text.find('\n', self.pos)
+        self.pos = len(self.text) if end == -1 else end
+
+    def expand(self, name):
+        if name not in self.variables:
+            raise Unsupported('Undefined variable ' + name)
+        value = self.variables[name]
+        if isinstance(value, list):
+            return value[0] if value else ''
+        return value
+
+    def parse_expansion(self):
+        """Parses $name and ${name} at the current position"""
+        self.pos += 1
+        if self.peek() == '{':
+            end = self.text.find('}', self.pos)
+            name = self.text[self.pos + 1:end]
+            if end == -1 or not re_name.fullmatch(name):
+                raise Unsupported('Parameter expansion')
+            self.pos = end + 1
+        else:
+            match = re_name.match(self.text, self.pos)
+            if not match:
+                raise Unsupported('Special parameter')
+            name = match.group(0)
+            self.pos = match.end()
+        return self.expand(name)
+
+    def parse_double_quotes(self):
+        self.pos += 1
+        value = ''
+        while True:
+            c = self.peek()
+            if c == '':
+                raise Unsupported('Unterminated quote')
+            elif c == '"':
+                self.pos += 1
+                return value
+            elif c == '\\':
+                n = self.peek(1)
+                if n == '\n':
+                    pass
+                elif n in '$`"\\':
+                    value += n
+                else:
+                    value += c + n
+                self.pos += 2
+            elif c == '$':
+                value += self.parse_expansion()
+            elif c == '`':
+                raise Unsupported('Command substitution')
+            else:
+                value += c
+                self.pos += 1
+
+    def parse_word(self, in_array):
+        """Parses a single word. Returns None for words that expand to nothing."""
+        value = ''
+        literal = False
+        glob = False
+        while True:
+            c = self.peek()
+            if c == '' or c in ' \t\n;' or (c == ')' and in_array):
+                break
+            elif c == "'":
+                end = self.text.find("'", self.pos + 1)
+                if end == -1:
+                    raise Unsupported('Unterminated quote')
+                value += self.text[self.pos + 1:end]
+                self.pos = end + 1
+                literal = True
+            elif c == '"':
+                value += self.parse_double_quotes()
+                literal = True
+            elif c == '\\':
+                if self.peek(1) == '':
+                    raise Unsupported('Trailing backslash')
+                if self.peek(1) != '\n':
+                    value += self.peek(1)
+                    literal = True
+                self.pos += 2
+            elif c == '$':
+                if self.peek(1) in "('\"":
+                    raise Unsupported('Substitution')
+                expanded = self.parse_expansion()
+                # Unquoted expansions are split and globbed inside arrays
+                if in_array and (set(expanded) & (ifs_chars | glob_chars)):
+                    raise Unsupported('Word splitting')
+                value += expanded
+            elif c in '`(){}<>|&' or (c == '~' and value == '' and not literal):
+                raise Unsupported('Special character ' + c)
+            else:
+                glob = glob or c in glob_chars
+                value += c
+                literal = True
+                self.pos += 1
+        # Unquoted globs inside arrays would be expanded, urls will not match any file
+        if in_array and glob and '://' not in value:
+            raise Unsupported('Glob')
+        if not literal and value == '':
+            return None
+        return value
+
+    def parse_array(self):
+        self.pos += 1
+        values = []
+        while True:
+            self.skip_blanks(newlines=True)
+            c = self.peek()
+            if c == '':
+                raise Unsupported('Unterminated array')
+            elif c == ')':
+                self.pos += 1
+                return values
+            elif c == ';':
+                raise Unsupported('Separator in array')
+            word = self.parse_word(in_array=True)
+            if word is not None:
+                values += [word]
+
+    def parse_assignment(self, match):
+        name, operator = match.groups()
+        self.pos = match.end()
+        if self.peek() == '(':
+            value = self.parse_array()
+        else:
+            value = self.parse_word(in_array=False) or ''
+
+        old = self.variables.get(name)
+        if operator == '+=' and old is not None:
+            if isinstance(value, list):
+                value = (old if isinstance(old, list) else [old]) + value
+            elif isinstance(old, list):
+                raise Unsupported('Append to array element')
+            else:
+                value = old + value
+        self.variables[name] = value
+
+    def skip_function(self, match):
+        # Functions are not executed. Require a closing brace on its own line.
+        end = self.text.find('\n}', match.end() - 1)
+        if end == -1:
+            raise Unsupported('Function end not found')
+        self.pos = end + 2
+        self.skip_blanks()
+        c = self.peek()
+        if c not in ('', '\n', '#'):
+            raise Unsupported('Function end')
+
+    def parse(self):
+        at_line_start = True
+        while True:
+            self.skip_blanks()
+            c = self.peek()
+            if c == '':
+                return self.variables
+            elif c == '\n':
+                self.pos += 1
+                at_line_start = True
+                continue
+            elif c == '#':
+                self.skip_comment()
+                continue
+            elif c == ';' and not at_line_start:
+                self.pos += 1
+                continue
+
+            match = re_assignment.match(self.text, self.pos)
+            if match:
+                self.parse_assignment(match)
+                at_line_start = False
+                continue
+
+            match = re_function.match(self.text, self.pos)
+            if match and at_line_start:
+                self.skip_function(match)
+                continue
+
+            raise Unsupported('Command in line ' + str(self.text.count('\n', 0, self.pos) + 1))
+
+def echo_words(values):
+    """Simulate an unquoted echo: Collapse whitespace and reject echo options and globs"""
+    words = []
+    for value in values:
+        for word in value.split():
+            if re.fullmatch(r'-[neE]+', word) or '\\' in word:
+                raise Unsupported('Echo option or escape')
+            if set(word) & glob_chars and '://' not in word:
+                raise Unsupported('Glob')
+            words += [word]
+    return words
+
+def parse_simple(text):
+    """Parse a PKGBUILD without bash. Returns a list with the package dict
+    or None if the PKGBUILD contains anything beyond simple assignments.
+    """
+    try:
+        variables = SimpleParser(text).parse()
+    except Unsupported:
+        return None
+
+    def first(name):
+        value = variables.get(name, '')
+        if isinstance(value, list):
+            return value[0] if value else ''
+        return value
+
+    # Split packages are handled by namcap
+    if 'pkgbase' in variables or (isinstance(variables.get('pkgname'), list) and len(variables['pkgname']) != 1):
+        return None
+    if not first('pkgname') or not first('pkgver') or not first('pkgrel'):
+        return None
+
+    package = {}
+    try:
+        for variable, key, kind in [('pkgname', 'name', 'scalar')] + fields:
+            if not first(variable):
+                continue
+            if kind == 'scalar':
+                value = first(variable)
+                if '\\' in value or '\n' in value or value != value.strip():
+                    raise Unsupported('Scalar value')
+                package[key] = value
+            else:
+                values = variables[variable]
+                if not isinstance(values, list):
+                    values = [values]
+                if kind == 'words':
+                    package[key] = echo_words(values)
+                else:
+                    package[key] = []
+                    for value in values:
+                        words = echo_words([value])
+                        if not words:
+                            raise Unsupported('Empty array element')
+                        package[key] += [' '.join(words)]
+                if not package[key]:
+                    raise Unsupported('Empty array')
+        version = first('pkgver') + '-' + first('pkgrel')
+        if '\\' in version or set(version) & ifs_chars:
+            raise Unsupported('Version')
+        package['version'] = version
+    except Unsupported:
+        return None
+    return [package]
+
+# parsepkgbuild.sh fields with a single value
+single_fields = ['name', 'version', 'desc', 'url', 'install', 'base', 'builddate', 'packager', 'split']
+re_field = re.compile(r'%([A-Z0-9]+)%')
+
+def parse_desc(text):
+    """Parse parsepkgbuild.sh output into a list of (split) package dicts"""
+    chunks = []
+    for chunk in text.split('\0\n'):
+        pkg = {}
+        key = None
+        for line in chunk.split('\n'):
+            match = re_field.fullmatch(line)
+            if match:
+                key = match.group(1).lower()
+                pkg[key] = []
+            elif line == '':
+                key = None
+            elif key:
+                pkg[key] += [line]
+        for key in single_fields:
+            if key in pkg:
+                pkg[key] = pkg[key][0] if pkg[key] else ''
+        chunks += [pkg]
+
+    if 'split' not in chunks[0]:
+        return chunks[:1]
+
+    packages = []
+    for pkg in chunks[1:]:
+        pkg['base'] = chunks[0]['base']
+        packages += [pkg]
+    return packages
+
+class BatchWorker(object):
+    """Long-lived parsepkgbuild.sh process that parses PKGBUILDs read from stdin.
+    This avoids starting a new bash process for every PKGBUILD.
+    Every PKGBUILD is sourced in a restricted subshell inside its directory, like namcap does.
+    """
+    def __init__(self, script=None):
+        if not script:
+            path = os.environ.get('PARSE_PKGBUILD_PATH', os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+            script = os.path.join(path, 'parsepkgbuild.sh')
+        self.process = subprocess.Popen(['bash', script, '--batch'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def parse(self, pkgbuildpath):
+        """Returns the package dicts of a PKGBUILD or None if it is invalid"""
+        if '\n' in pkgbuildpath:
+            return None
+
+        # A new random token per PKGBUILD marks the end of the record, the PKGBUILD cannot know it
+        token = secrets.token_hex(16).encode('ascii')
+        end = b'%LSD_END% ' + token + b' '
+        self.process.stdin.write(token + b'\n' + os.fsencode(os.path.abspath(pkgbuildpath)) + b'\n')
+        self.process.stdin.flush()
+
+        # Read the framed record
+        lines = []
+        for line in self.process.stdout:
+            if line.startswith(end):
+                status = int(line[len(end):])
+                break
+            lines += [line]
+        else:
+            raise RuntimeError('parsepkgbuild.sh batch worker died')
+
+        if status:
+            return None
+        # Drop the newline written before the end marker
+        return parse_desc(b''.join(lines)[:-1].decode('utf-8', 'replace'))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+# One worker per process, started on first use
+batch_worker = None
+
+def parse_batch(pkgbuildpath):
+    global batch_worker
+    if batch_worker is None:
+        batch_worker = BatchWorker()
+    return batch_worker.parse(pkgbuildpath)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import re
+import time
+import asyncio
+import contextvars
+import urllib.parse
+import aiohttp
+import logging
+
+from .gpg import GPG
+
+# Links of html directory listings (Apache, nginx, lighttpd autoindex)
+re_href = re.compile(r'href\s*=\s*["\']([^"\'#?]+)', re.IGNORECASE)
+
+# Failed requests (url, transient) of the source analyzed by the current task
+source_errors = contextvars.ContextVar('source_errors', default=None)
+
+class Prober(object):
+    """Checks source urls concurrently with asyncio.
+    All requests share one aiohttp session with pooled keep-alive connections.
+    'limit' caps the number of concurrent connections, 'per_host' the connections to a single host.
+    Probe results are stored in the optional cache. Available urls are reused for 'ttl' seconds,
+    unavailable ones for 'negative_ttl' seconds. Afterwards available urls are revalidated
+    with a conditional request to the final url.
+    Signatures are looked up in the directory listing of a source if the server provides one,
+    so all sources of a directory need a single request instead of several per source.
+    Timeouts and server errors are never cached, they only fail the current source.
+    The capabilities of every host are tracked during the run. Requests to hosts that repeatedly
+    failed to connect are skipped. HEAD requests refused by a server are repeated with GET without
+    reading the body, hosts that repeatedly refused HEAD are asked with GET directly.
+    With persist_hosts the host table is stored in the cache and reused for 'negative_ttl' seconds.
+    With a budget in seconds no new sources are started after the budget is used up.
+    """
+    def __init__(self, limit=64, per_host=4, timeout=10, cache=None, ttl=7 * 24 * 3600, negative_ttl=24 * 3600,
+            persist_hosts=False, host_failures=3, budget=None, ssl=None, logger=None):
+        self.limit = limit
+        self.per_host = per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.logger = logger or logging.getLogger(__name__)
+        self.session = None
+        self.listings = {}
+        self.listing_size = 4 * 1024 * 1024
+        self.persist_hosts = persist_hosts
+        self.host_failures = host_failures
+        self.hosts = {}
+        self.budget = budget
+        self.ssl = ssl
+        self.deadline = None
+        self.expired = False
+        self.stats = {'cached': 0, 'revalidated': 0, 'probed': 0, 'listings': 0, 'skipped': 0}
+
+    def host(self, url):
+        """Returns the capabilities of the host of an url"""
+        name = urllib.parse.urlsplit(url).netloc.lower()
+        if name not in self.hosts:
+            host = None
+            if self.persist_hosts and self.cache is not None:
+                try:
+                    host = self.cache.get('host:' + name)
+                except KeyError:
+                    pass
+                if host and int(time.time()) - host['time'] >= self.negative_ttl:
+                    host = None
+            # Successful and failed connections and the kind of the last failure per scheme
+            self.hosts[name] = host or {'time': int(time.time()), 'http': [0, 0], 'https': [0, 0],
+                    'errors': {'http': None, 'https': None}, 'head': [0, 0], 'redirects': 0, 'downgrades': 0}
+        return self.hosts[name]
+
+    def reachable(self, url):
+        """Check if a host is known to be unreachable with the scheme of url"""
+        host = self.host(url)
+        scheme = 'https' if url.startswith('https://') else 'http'
+        if not host[scheme][0] and host[scheme][1] >= self.host_failures:
+            # The skipped request fails like the requests to the host before
+            # TLS failures only mean that https is not usable
+            self.stats['skipped'] += 1
+            error = host.get('errors', {}).get(scheme, 'connection')
+            if error == 'timeout':
+                self.transient_error(url)
+            elif error == 'connection':
+                self.connection_error(url)
+            return False
+        return True
+
+    def head_refused(self, url):
+        """Check if the host of url is known to refuse HEAD requests"""
+        host = self.host(url)
+        return not host['head'][0] and host['head'][1] >= self.host_failures
+
+    def transient_error(self, url):
+        """Fail the current source because of a timeout or server error"""
+        errors = source_errors.get()
+        if errors is not None:
+            errors.append((url, True))
+
+    def connection_error(self, url):
+        """Record a refused connection or unknown host of the current source.
+        It only fails the source if the host is not reachable with any scheme, see unreachable().
+        """
+        errors = source_errors.get()
+        if errors is not None:
+            errors.append((url, False))
+
+    def unreachable(self, url):
+        """Check if no connection to the host of url succeeded.
+        A host that is down must not wipe its sources, but a closed https port
+        of a host that answers plain http simply means that https is not available.
+        A failed TLS handshake also reached the host.
+        """
+        host = self.host(url)
+        return not host['http'][0] and not host['https'][0] and 'tls' not in host.get('errors', {}).values()
+
+    def connected(self, url, ok, error=None):
+        """Count a connection to the host of url, error is 'timeout', 'connection' or 'tls'"""
+        host = self.host(url)
+        scheme = 'https' if url.startswith('https://') else 'http'
+        host[scheme][0 if ok else 1] += 1
+        if error:
+            host.setdefault('errors', {})[scheme] = error
+
+    async def request(self, method, url, headers=None, allow_redirects=True):
+        """Returns status, final url, ETag and Last-Modified of a request without reading the body.
+        The status is None if the request failed.
+        """
+        if not self.reachable(url):
+            return None, None, None, None
+        try:
+            async with self.session.request(method, url, headers=headers, allow_redirects=allow_redirects) as ret:
+                status, final_url = ret.status, str(ret.url)
+                etag, last_modified = ret.headers.get('ETag'), ret.headers.get('Last-Modified')
+                redirected = bool(ret.history)
+        except aiohttp.ClientSSLError:
+            self.logger.debug('SSL error %s', url)
+            self.connected(url, False, 'tls')
+            return None, None, None, None
+        except asyncio.TimeoutError:
+            self.logger.debug('Read timeout %s', url)
+            self.connected(url, False, 'timeout')
+            self.transient_error(url)
+            return None, None, None, None
+        except aiohttp.ClientConnectionError:
+            self.logger.debug('Connection error %s', url)
+            self.connected(url, False, 'connection')
+            self.connection_error(url)
+            return None, None, None, None
+        except (aiohttp.ClientError, ValueError):
+            self.logger.debug('Redirect to ftp or other unsupported protocol %s', url)
+            return None, None, None, None
+
+        # Record the host behaviour
+        host = self.host(url)
+        self.connected(url, True)
+        if self.transient(status):
+            self.transient_error(url)
+        if redirected:
+            host['redirects'] += 1
+            if url.startswith('https://') and final_url.startswith('http://'):
+                host['downgrades'] += 1
+        return status, final_url, etag, last_modified
+
+    async def head(self, url, headers=None, allow_redirects=True):
+        """Returns status, final url, ETag and Last-Modified of a HEAD request.
+        Some servers like GitHub refuse HEAD requests, those urls are checked with GET instead.
+        The status is None if the request failed.
+        """
+        if self.head_refused(url):
+            return await self.request('GET', url, headers, allow_redirects)
+        status, final_url, etag, last_modified = await self.request('HEAD', url, headers, allow_redirects)
+        if status in (200, 304):
+            self.host(final_url)['head'][0] += 1
+        elif status in (403, 405, 501):
+            # Many CDNs also answer 403 for missing files, only count a refusal if GET succeeds
+            ret = await self.request('GET', url, headers, allow_redirects)
+            if ret[0] in (200, 304):
+                self.host(ret[1])['head'][1] += 1
+            return ret
+        return status, final_url, etag, last_modified
+
+    def transient(self, status):
+        """Check if a http status is a temporary server problem"""
+        return status >= 500 or status == 429
+
+    async def revalidate(self, entry):
+        """Check with a conditional request if the cached final url is still available"""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        if not headers:
+            return False
+
+        status, final_url, etag, last_modified = await self.head(entry['final_url'], headers, allow_redirects=False)
+        if status == 304:
+            return True
+        elif status == 200:
+            entry['etag'] = etag
+            entry['last_modified'] = last_modified
+            return True
+        return False
+
+    async def check_url(self, url, cached=True):
+        """Returns the final url after redirects if it is available, otherwise None.
+        With cached=False the cache is not read, but still updated.
+        Failed requests and temporary server errors are not cached.
+        """
+        now = int(time.time())
+        entry = None
+        if self.cache is not None and cached:
+            try:
+                entry = self.cache.get(url)
+            except KeyError:
+                pass
+
+        # Ignore failed requests cached by older versions
+        if entry and entry['status'] is not None and not self.transient(entry['status']):
+            # Use fresh cache entries
+            ttl = self.ttl if entry['status'] == 200 else self.negative_ttl
+            if now - entry['time'] < ttl:
+                self.stats['cached'] += 1
+                return entry['final_url'] if entry['status'] == 200 else None
+
+            # Revalidate outdated available urls without following the redirects again
+            if entry['status'] == 200 and await self.revalidate(entry):
+                self.stats['revalidated'] += 1
+                entry['time'] = now
+                self.cache.set(url, entry)
+                return entry['final_url']
+
+        self.stats['probed'] += 1
+        status, final_url, etag, last_modified = await self.head(url)
+        if self.cache is not None and status is not None and not self.transient(status):
+            self.cache.set(url, {'status': status, 'final_url': final_url, 'etag': etag,
+                    'last_modified': last_modified, 'time': now})
+
+        # Evaluate http status code
+        if status is None:
+            return None
+        elif status == 200:
+            self.logger.debug('200 OK %s', final_url)
+            return final_url
+        else:
+            self.logger.debug('Http status code: %s %s', status, url)
+            return None
+
+    async def get_listing(self, directory):
+        """Returns the final url and the file names of a html directory listing or None.
+        Listings larger than listing_size are incomplete and therefore not used.
+        """
+        if not self.reachable(directory):
+            return None
+        try:
+            async with self.session.get(directory, allow_redirects=True) as ret:
+                self.connected(directory, True)
+                if ret.status != 200 or 'html' not in ret.headers.get('Content-Type', ''):
+                    return None
+                if (ret.content_length or 0) > self.listing_size:
+                    self.logger.debug('Directory listing too large %s', directory)
+                    return None
+
+                # read(n) only returns the buffered data, read until the end or the size limit
+                body = bytearray()
+                while len(body) <= self.listing_size:
+                    chunk = await ret.content.read(self.listing_size + 1 - len(body))
+                    if not chunk:
+                        break
+                    body += chunk
+                if len(body) > self.listing_size:
+                    self.logger.debug('Directory listing too large %s', directory)
+                    return None
+                text = body.decode('utf-8', 'replace')
+                base = str(ret.url)
+        except aiohttp.ClientSSLError:
+            self.logger.debug('No directory listing %s', directory)
+            self.connected(directory, False, 'tls')
+            return None
+        except asyncio.TimeoutError:
+            self.logger.debug('No directory listing %s', directory)
+            self.connected(directory, False, 'timeout')
+            return None
+        except aiohttp.ClientConnectionError:
+            self.logger.debug('No directory listing %s', directory)
+            self.connected(directory, False, 'connection')
+            return None
+        except (aiohttp.ClientError, ValueError):
+            self.logger.debug('No directory listing %s', directory)
+            return None
+
+        self.stats['listings'] += 1
+        names = set(urllib.parse.unquote(href.rstrip('/').rsplit('/', 1)[-1]) for href in re_href.findall(text))
+        return base, names
+
+    async def listing(self, directory):
+        # Request every directory only once, concurrent lookups wait for the same request
+        if directory not in self.listings:
+            self.listings[directory] = asyncio.ensure_future(self.get_listing(directory))
+        return await self.listings[directory]
+
+    async def analyze_sig_listing(self, url):
+        """Looks up the signature of url in its directory listing.
+        Returns (True, signature url or None) if the listing contains the source itself,
+        otherwise (False, None) and the signatures need to be probed one by one.
+        """
+        if '?' in url or url.count('/') < 3:
+            return False, None
+        directory, filename = url.rsplit('/', 1)
+        if not filename:
+            return False, None
+
+        # Try https first, then normal http
+        directories = [directory + '/']
+        if url.startswith('http://'):
+            directories.insert(0, directory.replace('http://', 'https://', 1) + '/')
+        for directory in directories:
+            listing = await self.listing(directory)
+            if listing is None:
+                continue
+
+            # Only trust listings of the source directory
+            base, names = listing
+            if urllib.parse.unquote(filename) not in names:
+                continue
+            for sig in GPG.signatures:
+                if urllib.parse.unquote(filename + sig) in names:
+                    return True, urllib.parse.urljoin(base, filename + sig)
+            return True, None
+        return False, None
+
+    async def analyze_sig(self, url):
+        # Filter out SVC and local sources
+        # TODO and not url.startswith('ftp://')
+        if not url.startswith('http://') and not url.startswith('https://'):
+            return None
+
+        # Filter out signatures themselves
+        if url.endswith(tuple(GPG.signatures)):
+            return None
+
+        # Look for signatures in the directory listing
+        found, sigurl = await self.analyze_sig_listing(url)
+        if found:
+            return sigurl
+
+        # Try to get any available signature
+        # TODO skip urls like https://cgit.kde.org/akonadi.git/patch/?id=2dc7fbf5.sig
+        for sig in GPG.signatures:
+            sigurl = url + sig
+            # Try https first, then normal http
+            if url.startswith('http://'):
+                new_url = await self.check_url(sigurl.replace('http://', 'https://', 1))
+                if new_url:
+                    return new_url
+            new_url = await self.check_url(sigurl)
+            if new_url:
+                return new_url
+        return None
+
+    async def analyze_https(self, url, cached=True):
+        # Filter out SVC, ftp and local sources
+        new_url = None
+        if url.startswith('http://'):
+            new_url = await self.check_url(url.replace('http://', 'https://', 1), cached)
+        elif url.startswith('https://'):
+            new_url = await self.check_url(url, cached)
+
+        # check https -> http redirect
+        if new_url and new_url.startswith('http://'):
+            self.logger.warn('Bad https -> http redirect: %s', new_url)
+        # None as return either means no https is available or the webserver refuses to download
+        # the head of the request. This happens for github:
+        # https://github.com/rpm-software-management/rpmlint/issues/71
+        return new_url
+
+    async def analyze_source(self, src):
+        """Sets sig_url, https_url and mirror of a source"""
+        url = src['url']
+        src['sig_url'], src['https_url'] = await asyncio.gather(self.analyze_sig(url), self.analyze_https(url))
+
+        # Query twice to check for mirror downloads with changing sources
+        # The second query must not be answered from the cache
+        src['mirror'] = False
+        if src['https_url']:
+            mirror_url = await self.analyze_https(url, cached=False)
+            if mirror_url == src['https_url']:
+                src['mirror'] = True
+        return src
+
+    async def worker(self, sources, callback):
+        # Sources are pulled from the shared iterator until it is exhausted or the budget is used up
+        for src in sources:
+            if self.deadline and time.time() > self.deadline:
+                self.expired = True
+                return
+            errors = []
+            source_errors.set(errors)
+            src = await self.analyze_source(src)
+            callback(src, any(transient or self.unreachable(url) for url, transient in errors))
+
+    async def probe(self, sources, callback):
+        # Use the default certificate verification unless an ssl context is given
+        kwargs = {'ssl': self.ssl} if self.ssl is not None else {}
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.per_host, **kwargs)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            sources = iter(sources)
+            await asyncio.gather(*[self.worker(sources, callback) for i in range(self.limit)])
+        self.session = None
+
+    def run(self, sources, callback):
+        """Analyze all sources and pass every analyzed source to callback(src, failed) as soon as it is done.
+        'failed' is True if a request of the source hit a timeout or a server error
+        or its host refused every connection.
+        """
+        if self.budget:
+            self.deadline = time.time() + self.budget
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.probe(sources, callback))
+        finally:
+            loop.close()
+            if self.cache is not None:
+                if self.persist_hosts:
+                    for name, host in self.hosts.items():
+                        self.cache.set('host:' + name, host)
+                self.cache.commit()
+        self.logger.info('Urls from cache %s, revalidated %s, probed %s, directory listings %s', self.stats['cached'],
+                self.stats['revalidated'], self.stats['probed'], self.stats['listings'])
+        self.logger.info('Skipped %s requests to unreachable hosts', self.stats['skipped'])
+        if self.expired:
+            print('Probe budget used up, the remaining sources are analyzed with the next run')
+
+    def report(self):
+        """Print the capabilities of all hosts with connection problems or unusual behaviour"""
+        rows = []
+        for name, host in sorted(self.hosts.items()):
+            if host['http'][1] or host['https'][1] or host['head'][1] or host['downgrades'] \
+                    or (host['http'][0] and not host['https'][0]):
+                https = 'yes' if host['https'][0] else ('no' if host['https'][1] else '?')
+                rows += [(name, '{}/{}'.format(*host['http']), '{}/{}'.format(*host['https']), https,
+                        host['head'][1], host['redirects'], host['downgrades'])]
+        if not rows:
+            return
+
+        print('Host capabilities (successful/failed connections):')
+        line = '{:<40} {:>9} {:>9} {:>6} {:>13} {:>10} {:>11}'
+        print(line.format('Host', 'HTTP', 'HTTPS', 'TLS', 'HEAD refused', 'Redirects', 'Downgrades'))
+        for row in rows:
+            print(line.format(*row))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import os
+import ssl
+import time
+import hashlib
+import socket
+import tempfile
+import threading
+import subprocess
+import collections
+import urllib.parse
+import http.server
+import socketserver
+
+# Offline stand-in for upstream servers to benchmark source probing without the internet.
+# One port serves plain http and https (the first byte of a TLS handshake is 0x16).
+# The behaviour is selected by the loopback address and the first path element:
+#
+# 127.0.0.1 http and https
+# 127.0.0.2 http only, TLS handshakes are closed
+# 127.0.0.3 accepts connections but never answers (timeouts)
+#
+# /signed/<dir>/<file>     file and <file>.sig
+# /asc/<dir>/<file>        file and <file>.asc
+# /unsigned/<dir>/<file>   file only, no signature
+# /listed/<dir>/<file>     file and <file>.sig, /listed/<dir>/ returns a directory listing
+# /redirect/<dir>/<file>   redirect chain of 'hops' redirects to /signed/<dir>/<file>
+# /downgrade/<dir>/<file>  https redirects to http
+# /nohead/<dir>/<file>     HEAD is refused with 405, like GitHub release downloads
+# /missing/<dir>/<file>    404 for the file and all signatures
+
+hosts = {
+    'full': '127.0.0.1',
+    'httponly': '127.0.0.2',
+    'timeout': '127.0.0.3',
+}
+kinds = ['signed', 'asc', 'unsigned', 'listed', 'redirect', 'downgrade', 'nohead', 'missing']
+signatures = {'signed': '.sig', 'listed': '.sig', 'redirect': '.sig', 'asc': '.asc'}
+
+def make_certificate(path):
+    """Create a self-signed certificate for the loopback addresses with openssl.
+    Returns the certificate and key file paths.
+    """
+    cert = os.path.join(path, 'cert.pem')
+    key = os.path.join(path, 'key.pem')
+    with open(os.path.join(path, 'openssl.cnf'), 'w') as f:
+        f.write('[req]\ndistinguished_name=dn\nx509_extensions=ext\nprompt=no\n[dn]\nCN=localhost\n'
+                '[ext]\nsubjectAltName=DNS:localhost,' + ','.join('IP:' + ip for ip in hosts.values()) + '\n'
+                'basicConstraints=critical,CA:TRUE\n')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', cert, '-config', os.path.join(path, 'openssl.cnf')],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.simulator.count(self.command, status)
+
+    def handle_request(self):
+        simulator = self.server.simulator
+        if simulator.latency:
+            time.sleep(simulator.latency)
+
+        scheme = 'https' if isinstance(self.connection, ssl.SSLSocket) else 'http'
+        origin = scheme + '://' + self.headers.get('Host', '')
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = path.strip('/').split('/')
+        kind = parts[0]
+        if kind not in kinds or len(parts) < 2:
+            return self.respond(404)
+
+        # Directory listing
+        if path.endswith('/'):
+            if kind != 'listed':
+                return self.respond(404)
+            names = simulator.directories.get(path, [])
+            links = ''.join('<a href="{0}">{0}</a>\n'.format(urllib.parse.quote(name)) for name in names)
+            return self.respond(200, {'Content-Type': 'text/html'}, ('<html><body>' + links + '</body></html>').encode('utf-8'))
+
+        name = parts[-1]
+        base = '/'.join(parts[1:-1])
+        sig = signatures.get(kind)
+        is_sig = name.endswith(('.sig', '.sign', '.asc'))
+        if kind == 'missing' or (is_sig and (not sig or not name.endswith(sig))):
+            return self.respond(404)
+
+        if kind == 'redirect':
+            # Chain through /redirect/~<hop>/ paths before the final redirect
+            rest = parts[1:]
+            hop = 0
+            if rest[0].startswith('~'):
+                hop = int(rest[0][1:])
+                rest = rest[1:]
+            if hop + 1 < simulator.hops:
+                target = '/redirect/~' + str(hop + 1) + '/' + '/'.join(rest)
+            else:
+                target = '/signed/' + '/'.join(rest)
+            return self.respond(302, {'Location': origin + target})
+        if kind == 'downgrade' and scheme == 'https':
+            return self.respond(301, {'Location': 'http://' + self.headers.get('Host', '') + '/unsigned/' + base + '/' + name})
+        if kind == 'nohead' and self.command == 'HEAD':
+            return self.respond(405)
+
+        etag = '"' + hashlib.md5(path.encode('utf-8')).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, {'ETag': etag})
+        return self.respond(200, {'Content-Type': 'application/octet-stream', 'ETag': etag})
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, simulator, tls=True, answer=True):
+        self.simulator = simulator
+        self.tls = tls
+        self.answer = answer
+        super(Server, self).__init__(address, Handler)
+
+    def finish_request(self, request, client_address):
+        # Never answer, let the client run into its timeout
+        if not self.answer:
+            self.simulator.count('CONNECT', 'timeout')
+            time.sleep(self.simulator.hang)
+            return
+
+        # Detect TLS handshakes
+        try:
+            first = request.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return
+        if first == b'\x16':
+            if not self.tls:
+                self.simulator.count('CONNECT', 'no tls')
+                return
+            try:
+                request = self.simulator.context.wrap_socket(request, server_side=True)
+            except (ssl.SSLError, OSError):
+                self.simulator.count('CONNECT', 'tls error')
+                return
+        super(Server, self).finish_request(request, client_address)
+
+class Simulator(object):
+    """Runs the stand-in upstream servers in background threads.
+    'latency' delays every answer in seconds, 'hops' is the length of redirect chains.
+    """
+    def __init__(self, latency=0.0, hops=2, hang=30):
+        self.latency = latency
+        self.hops = hops
+        self.hang = hang
+        self.servers = []
+        self.directories = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cert, key = make_certificate(self.tmpdir.name)
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(self.cert, key)
+        self.port = None
+
+    def count(self, method, status):
+        with self.lock:
+            self.requests[(method, status)] += 1
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+    def client_context(self):
+        """SSL context for clients that trusts the self-signed certificate"""
+        return ssl.create_default_context(cafile=self.cert)
+
+    def start(self):
+        # Use the same port on every loopback address
+        for name, tls, answer in [('full', True, True), ('httponly', False, True), ('timeout', True, False)]:
+            server = Server((hosts[name], self.port or 0), self, tls=tls, answer=answer)
+            self.port = server.server_address[1]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers += [server]
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.tmpdir.cleanup()
+
+    def urls(self, count, scheme='http'):
+        """Generate synthetic source urls spread over all hosts and behaviours"""
+        urls = []
+        for i in range(count):
+            if i % 20 == 19:
+                host = 'timeout'
+            elif i % 5 == 4:
+                host = 'httponly'
+            else:
+                host = 'full'
+            kind = kinds[i % len(kinds)]
+            directory = 'project{}'.format(i // 40)
+            name = 'project{}-{}.tar.gz'.format(i // 40, i)
+            urls += ['{}://{}:{}/{}/{}/{}'.format(scheme, hosts[host], self.port, kind, directory, name)]
+            if kind == 'listed':
+                self.directories['/listed/' + directory + '/'] += [name, name + '.sig']
+        return urls
+
+class KeyserverHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/pgp-keys' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.keyserver.count(status)
+
+    def do_GET(self):
+        keyserver = self.server.keyserver
+        if keyserver.latency:
+            time.sleep(keyserver.latency)
+
+        # HKP lookup: /pks/lookup?op=get&options=mr&search=0x<fingerprint or keyid>
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != '/pks/lookup' or query.get('op') != ['get'] or 'search' not in query:
+            return self.respond(404)
+        search = query['search'][0].upper()
+        if search.startswith('0X'):
+            search = search[2:]
+
+        for fingerprint, key in keyserver.keys.items():
+            if fingerprint.endswith(search):
+                if fingerprint in keyserver.failing:
+                    return self.respond(500)
+                return self.respond(200, key)
+        return self.respond(404)
+
+class Keyserver(object):
+    """Local HKP keyserver stand-in serving the armored keys of a dict {fingerprint: key}.
+    Keys in 'failing' are answered with a server error to test fallback keyservers.
+    """
+    def __init__(self, keys, failing=None, latency=0.0):
+        self.keys = {fingerprint.upper(): key.encode('utf-8') if isinstance(key, str) else key for fingerprint, key in keys.items()}
+        self.failing = set(fingerprint.upper() for fingerprint in failing or [])
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, status):
+        with self.lock:
+            self.requests[status] += 1
+
+    def start(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), KeyserverHandler)
+        self.server.daemon_threads = True
+        self.server.keyserver = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url()
+
+    def url(self):
+        return 'hkp://127.0.0.1:' + str(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -3,14 +3,71 @@
 from __future__ import print_function
 import os
 import sys
+import time
 import rethinkdb as r
 import hashlib
-import requests
 import logging
 import progressbar
 
 from .table import Table
-from .gpg import GPG
+from .probe import Prober
+
+class ProbeQueue(Table):
+    """Durable queue of source urls to probe.
+    Never probed urls come first, then the oldest results. Successful probes are repeated after
+    'refresh' seconds, failed probes are retried with exponential backoff.
+    """
+    attributes = ['sha256', # PK of the source
+                'url',
+                'last_probe', # Time of the last probe, 0 if never probed
+                'next_probe', # Do not probe before this time
+                'failures', # Number of failed probes in a row
+                ]
+
+    def __init__(self, conn, db, refresh=7 * 24 * 3600, backoff=3600, max_backoff=7 * 24 * 3600, logger=None):
+        super(ProbeQueue, self).__init__(conn, db, 'probe_queue', 'sha256', self.attributes, 'last_probe')
+        self.refresh = refresh
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self.start()
+
+    def sync(self, sources):
+        """Add new sources to the queue and remove the entries of deleted sources.
+        Probed sources without results (e.g. after dropping the table) are queued as never probed again.
+        """
+        queue = {entry['sha256']: entry for entry in r.db(self.db).table(self.table).pluck('sha256', 'last_probe', 'failures').run(self.conn)}
+        cursor = r.db(self.db).table(sources).pluck('sha256', 'url', 'timestamp').run(self.conn)
+        with self.bulk(replace=True, durability='soft') as writer:
+            for src in cursor:
+                entry = queue.pop(src['sha256'], None)
+                analyzed = src.get('timestamp') is not None
+                if entry is not None and (analyzed or not entry['last_probe'] or entry['failures']):
+                    continue
+                last_probe = int(src['timestamp'].timestamp()) if analyzed else 0
+                writer.insert({'sha256': src['sha256'], 'url': src['url'], 'last_probe': last_probe,
+                        'next_probe': last_probe + self.refresh if analyzed else 0, 'failures': 0})
+
+        if queue:
+            r.db(self.db).table(self.table).get_all(*queue).delete(durability='soft').run(self.conn)
+
+    def due(self, force=False):
+        """Returns the query of all urls to probe in queue order"""
+        query = r.db(self.db).table(self.table).order_by(index='last_probe')
+        if not force:
+            query = query.filter(r.row['next_probe'] <= int(time.time()))
+        return query
+
+    def done(self, writer, entry, failed):
+        """Schedule the next probe of a queue entry"""
+        now = int(time.time())
+        if failed:
+            failures = entry['failures'] + 1
+            next_probe = now + min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+        else:
+            failures = 0
+            next_probe = now + self.refresh
+        writer.insert({'sha256': entry['sha256'], 'last_probe': now, 'next_probe': next_probe, 'failures': failures})
 
 class Sources(Table):
     attributes = ['sha256', # ID as PK, because the length is limited
@@ -23,132 +80,147 @@ class Sources(Table):
                 'timestamp',
                 ]
 
-    def __init__(self, conn, db, force=False, logger=None):
+    def __init__(self, conn, db, force=False, probe_limit=64, probe_per_host=4, probe_cache=None, probe_ttl=7 * 24 * 3600, probe_negative_ttl=24 * 3600, probe_persist_hosts=False, probe_budget=None, probe_timeout=10, probe_ssl=None, logger=None):
         super(Sources, self).__init__(conn, db, 'sources', 'sha256', self.attributes, 'url')
         self.force = force
         self.logger = logger or logging.getLogger(__name__)
+        self.lookup = {}
+        self.complete = False
+        self.pending = {}
+        self.changed = set()
+        self.probe_limit = probe_limit
+        self.probe_per_host = probe_per_host
+        self.probe_cache = probe_cache
+        self.probe_ttl = probe_ttl
+        self.probe_negative_ttl = probe_negative_ttl
+        self.probe_persist_hosts = probe_persist_hosts
+        self.probe_budget = probe_budget
+        self.probe_timeout = probe_timeout
+        self.probe_ssl = probe_ssl
         self.start()
+        self.queue = ProbeQueue(conn, db, refresh=probe_ttl)
 
     def parse(self, sources):
-        # Skip parsed sources
-        available_sources = list(r.db(self.db).table(self.table)['url'].run())
-        sources = [x for x in sources if x not in available_sources]
-
-        # Don't show progressbar if count is zero
-        count = len(sources)
-        if not count:
-            return
+        """Add new source urls and report sources which are no longer used by any package"""
+        # Compare against the keys of existing sources
+        existing = set(r.db(self.db).table(self.table)[self.pk].run(self.conn))
+        referenced = set()
 
         # Add all new sources
-        with progressbar.ProgressBar(max_value=count) as bar:
+        added = 0
+        with progressbar.ProgressBar(max_value=progressbar.UnknownLength) as bar, \
+                self.bulk(durability='soft') as writer:
             for i, src in enumerate(sources):
                 bar.update(i)
+                sha256 = self.hash(src)
+                if sha256 in referenced:
+                    continue
+                referenced.add(sha256)
 
-                # Insert new packages into database
-                sha256 = hashlib.sha256(src.encode('utf-8')).hexdigest()
-                data = {'sha256': sha256, 'url': src}
-                self.insert(data, name=src)
-
-    def check_url(self, url):
-        try:
-            ret = requests.head(url, allow_redirects=True, timeout=10)
-        except requests.exceptions.SSLError:
-            self.logger.debug('SSL error %s', url)
-            return None
-        except requests.exceptions.ConnectionError:
-            self.logger.debug('Connection error %s', url)
-            return None
-        except requests.exceptions.ReadTimeout:
-            self.logger.debug('Read timeout %s', url)
-            return None
-        except requests.exceptions.InvalidSchema:
-            self.logger.debug('Redirect to ftp or other unsupported protocol %s', url)
-            return None
-
-        # Evaluate http status code
-        if ret.status_code == 200:
-            self.logger.debug('200 OK %s', ret.url)
-            return ret.url
-        else:
-            self.logger.debug('Http status code: %s %s', ret.status_code, url)
-            return None
-
-    def analyze_sig(self, url):
-        # Filter out SVC and local sources
-        # TODO and not url.startswith('ftp://')
-        if not url.startswith('http://') and not url.startswith('https://'):
-            return None
-
-        # Filter out signatures themselves
-        if url.endswith(tuple(GPG.signatures)):
-            return None
-
-        # Try to get any available signature
-        # TODO skip urls like https://cgit.kde.org/akonadi.git/patch/?id=2dc7fbf5.sig
-        for sig in GPG.signatures:
-            sigurl = url + sig
-            # Try https first, then normal http
-            if url.startswith('http://'):
-                new_url = self.check_url(sigurl.replace('http://', 'https://', 1))
-                if new_url:
-                    return new_url
-            new_url = self.check_url(sigurl)
-            if new_url:
-                return new_url
-        return None
-
-    def analyze_https(self, url):
-        # Filter out SVC, ftp and local sources
-        new_url = None
-        if url.startswith('http://'):
-            new_url = self.check_url(url.replace('http://', 'https://', 1))
-        elif url.startswith('https://'):
-            new_url = self.check_url(url)
-
-        # check https -> http redirect
-        if new_url and new_url.startswith('http://'):
-            self.logger.warn('Bad https -> http redirect: %s', new_url)
-        # None as return either means no https is available or the webserver refuses to download
-        # the head of the request. This happens for github:
-        # https://github.com/rpm-software-management/rpmlint/issues/71
-        return new_url
+                # Insert new sources into database
+                if sha256 not in existing:
+                    writer.insert({'sha256': sha256, 'url': src})
+                    added += 1
+        print('Added', added, 'new sources')
+
+        # Report sources without package
+        orphans = existing - referenced
+        if orphans:
+            print('Found', len(orphans), 'orphaned sources')
+            for src in r.db(self.db).table(self.table).get_all(*orphans).pluck('url').run(self.conn):
+                self.logger.info('Orphaned source %s', src['url'])
 
     def analyze(self):
-        # Get sources to analyse
-        if self.force:
-            sources = r.db(self.db).table(self.table).run()
-            count = r.db(self.db).table(self.table).count().run()
-        else:
-            # Exclude already parsed entries
-            sources = r.db(self.db).table(self.table).filter(~r.row.has_fields('timestamp')).run()
-            count = r.db(self.db).table(self.table).filter(~r.row.has_fields('timestamp')).count().run()
+        # Get sources to analyse from the probe queue
+        # Without force only never probed, outdated and retried sources are due
+        self.queue.sync(self.table)
+        query = self.queue.due(self.force)
+        count = query.count().run(self.conn)
 
         # Check if new sources exist
         if count == 0:
             self.logger.info('All sources already analyzed. Force with -f.')
             return
+        sources_table = r.db(self.db).table(self.table)
+        cursor = query.map(lambda entry: {'entry': entry, 'source': sources_table.get(entry['sha256'])}).run(self.conn)
 
-        # Analyse all selected sources
-        with progressbar.ProgressBar(max_value=count) as bar:
-            for i, src in enumerate(sources):
-                bar.update(i)
+        # Analyse all selected sources concurrently and write every result as soon as it is done
+        done = 0
+        failed_count = 0
+        entries = {}
+        old = {}
+        with progressbar.ProgressBar(max_value=count) as bar, \
+                self.bulk(update=True, size=20) as writer, \
+                self.queue.bulk(update=True, size=20) as queue_writer:
+            def prepare(cursor):
+                for row in cursor:
+                    src = row['source']
+                    if src is None:
+                        continue
+                    entries[src['url']] = row['entry']
+                    old[src['url']] = (src.get('timestamp') is not None, (src.get('sig_url'), src.get('https_url')))
+                    yield src
 
-                # Analyze
-                url = src['url']
-                src['sig_url'] = self.analyze_sig(url)
-                src['https_url'] = self.analyze_https(url)
+            def store(src, failed):
+                nonlocal done, failed_count
+                self.queue.done(queue_writer, entries.pop(src['url']), failed)
+                analyzed, previous = old.pop(src['url'])
+                changed = previous != (src['sig_url'], src['https_url'])
+                done += 1
+                bar.update(done)
 
-                # Query twice to check for mirror downloads with changing sources
-                src['mirror'] = False
-                if src['https_url']:
-                    mirror_url = self.analyze_https(url)
-                    if mirror_url == src['https_url']:
-                        src['mirror'] = True
+                # Keep the previous results and retry later if a request failed
+                # Never analyzed sources get the partial results without timestamp
+                if failed:
+                    failed_count += 1
+                    if analyzed:
+                        return
+                else:
+                    src['timestamp'] = r.now()
 
-                src['timestamp'] = r.now()
+                # Remember changed sources to invalidate the packages using them
+                if changed:
+                    self.changed.add(src['url'])
 
                 # Insert new packages into database
-                self.insert(src, update=True, name=url)
+                writer.insert(src)
+
+            prober = Prober(limit=self.probe_limit, per_host=self.probe_per_host, cache=self.probe_cache,
+                    ttl=self.probe_ttl, negative_ttl=self.probe_negative_ttl, persist_hosts=self.probe_persist_hosts,
+                    budget=self.probe_budget, timeout=self.probe_timeout, ssl=self.probe_ssl)
+            prober.run(prepare(cursor), store)
+        prober.report()
+        if failed_count:
+            print(failed_count, 'sources failed and are retried later')
+
+    def prefetch(self, urls):
+        """Load the sources of the given urls with a single query into the lookup cache"""
+        keys = [self.hash(url) for url in set(urls) if url not in self.lookup]
+        if not keys:
+            return
+        cursor = r.db(self.db).table(self.table).get_all(*keys).pluck('sha256', 'url', 'sig_url', 'https_url').run(self.conn)
+        for src in cursor:
+            self.lookup[src['url']] = src
+
+    def load_all(self):
+        """Load all sources into the lookup cache"""
+        cursor = r.db(self.db).table(self.table).pluck('sha256', 'url', 'sig_url', 'https_url').run(self.conn)
+        self.lookup = {src['url']: src for src in cursor}
+        self.complete = True
+
+    def get_source(self, url):
+        """Get a source from the lookup cache or the database"""
+        if url not in self.lookup:
+            if self.complete:
+                sys.exit('Error: Url not in source database. Run with "-p TODO -t sources" first. ' + url) # TODO text/params
+            src = r.db(self.db).table(self.table).get(self.hash(url)).run(self.conn)
+            if not src:
+                sys.exit('Error: Url not in source database. Run with "-p TODO -t sources" first. ' + url) # TODO text/params
+            self.lookup[url] = src
+        return self.lookup[url]
+
+    def hash(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
 
     def set_sig(self, url, sig):
         """Add new known signature for url
@@ -157,39 +229,30 @@ class Sources(Table):
         On Github some users use the (insecure) Github downloads and sign them locally.
         The uploaded signature is available under a different path.
         With this function we also add this "hidden" information within the script.
+        The change is written to the database with the next flush().
         """
-
-        # Insert new packages into database
-        sha256 = hashlib.sha256(url.encode('utf-8')).hexdigest()
-        src = r.db(self.db).table(self.table).get(sha256).run(self.conn)
-        if not src:
-            sys.exit('Error: Url not in source database. Run with "-p TODO -t sources" first. ' + url) # TODO text/params
+        src = self.get_source(url)
         if src['sig_url'] == sig:
             return
         src['sig_url'] = sig
-        self.insert(src, update=True, name=url)
+        self.pending[url] = sig
+
+    def flush(self):
+        """Write all buffered signature changes"""
+        if not self.pending:
+            return
+        with self.bulk(update=True) as writer:
+            for url, sig in self.pending.items():
+                writer.insert({'sha256': self.hash(url), 'sig_url': sig})
+        self.pending = {}
 
     def get_sig(self, url):
         # Get signature from url
-        sha256 = hashlib.sha256(url.encode('utf-8')).hexdigest()
-        ret = r.db(self.db).table(self.table).get(sha256).run(self.conn)
-        if not ret:
-            sys.exit('Error: Url not in source database. Run with "-p TODO -t sources" first. ' + url) # TODO text/params
-        if ret['sig_url']:
-            return ret['sig_url']
-        else:
-            return None
+        return self.get_source(url)['sig_url'] or None
 
     def get_https(self, url):
-        # Get signature from url
-        sha256 = hashlib.sha256(url.encode('utf-8')).hexdigest()
-        ret = r.db(self.db).table(self.table).get(sha256).run(self.conn)
-        if not ret:
-            sys.exit('Error: Url not in source database. Run with "-p TODO -t sources" first. ' + url) # TODO text/params
-        if ret['https_url']:
-            return ret['https_url']
-        else:
-            return None
+        # Get https url from url
+        return self.get_source(url)['https_url'] or None
 
     def clean(self):
         pass
@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import sys
+import time
 import rethinkdb as r
 import logging
 
@@ -41,7 +42,19 @@ class Table(object):
                 r.db(self.db).table(self.table).index_create(self.index).run()
                 r.db(self.db).table(self.table).index_wait(self.index).run()
 
-    def insert(self, data, update=False, replace=False, name=None):
+    def ensure_index(self, name, function=None, multi=False):
+        """Create a secondary index if it does not exist yet"""
+        table = r.db(self.db).table(self.table)
+        if name in table.index_list().run(self.conn):
+            return
+        print('Creating index', name, 'for table', self.table)
+        if function is None:
+            table.index_create(name, multi=multi).run(self.conn)
+        else:
+            table.index_create(name, function, multi=multi).run(self.conn)
+        table.index_wait(name).run(self.conn)
+
+    def fill(self, data, update=False):
         # Fill empty attributes
         # TODO filter not available attributes?
         if not update:
@@ -49,6 +62,7 @@ class Table(object):
                 if attribute not in data:
                     data[attribute] = None
 
+    def conflict(self, update=False, replace=False):
         # Set conflict options
         conflict='error'
         if update and replace:
@@ -58,6 +72,11 @@ class Table(object):
             conflict='update'
         elif replace:
             conflict='replace'
+        return conflict
+
+    def insert(self, data, update=False, replace=False, name=None):
+        self.fill(data, update)
+        conflict = self.conflict(update, replace)
 
         # Insert data
         ret = r.db(self.db).table(self.table).insert(data, conflict=conflict).run(self.conn)
@@ -80,3 +99,67 @@ class Table(object):
             self.logger.critical('Unknown database information')
             print(ret)
             sys.exit()
+
+    def bulk(self, update=False, replace=False, size=200, interval=5, durability='hard'):
+        """Returns a BulkWriter that inserts documents in batches instead of one query per document"""
+        return BulkWriter(self, update=update, replace=replace, size=size, interval=interval, durability=durability)
+
+
+class BulkWriter(object):
+    """Buffers documents and writes them with a single insert query.
+    The buffer is flushed when it reaches 'size' documents or after 'interval' seconds.
+    Use durability='soft' for large import phases where the last batches may be lost on a crash.
+    """
+    def __init__(self, table, update=False, replace=False, size=200, interval=5, durability='hard'):
+        self.table = table
+        self.update = update
+        self.conflict = table.conflict(update, replace)
+        self.size = size
+        self.interval = interval
+        self.durability = durability
+        self.logger = table.logger
+        self.buffer = []
+        self.last_flush = time.time()
+        self.stats = {'inserted': 0, 'replaced': 0, 'unchanged': 0, 'errors': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def insert(self, data):
+        self.table.fill(data, self.update)
+        self.buffer += [data]
+        if len(self.buffer) >= self.size or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+
+        # Insert data and only transfer the changes of failed documents
+        pk = self.table.pk
+        query = r.db(self.table.db).table(self.table.table).insert(self.buffer, conflict=self.conflict,
+                durability=self.durability, return_changes='always')
+        query = query.merge(lambda ret: {'changes': ret['changes'].filter(lambda change: change.has_fields('error'))})
+        ret = query.run(self.table.conn)
+        self.logger.debug('Wrote %s documents to %s', len(self.buffer), self.table.table)
+        self.buffer = []
+
+        # Sum up insert status
+        for key in self.stats:
+            self.stats[key] += ret[key]
+
+        if ret['errors']:
+            for change in ret['changes']:
+                doc = change.get('new_val') or change.get('old_val') or {}
+                self.logger.critical('Error: %s %s', doc.get(pk, 'unknown ' + pk), change['error'])
+            sys.exit()
+
+    def close(self):
+        self.flush()
+        self.logger.info('Inserted %s, updated %s, unchanged %s documents in %s', self.stats['inserted'],
+                self.stats['replaced'], self.stats['unchanged'], self.table.table)
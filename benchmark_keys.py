@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import sys
+import time
+import tempfile
+import argparse
+import logging
+import rethinkdb as r
+import gnupg
+
+from LSD.gpg import GPG
+from LSD.simulator import Keyserver
+
+logging.basicConfig(level=logging.WARNING)
+
+def main(arguments):
+    """Generate test keys, serve them with local HKP keyserver stand-ins and
+    measure how fast GPG.recv_keys imports them into an empty keyring.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark GPG.recv_keys against local keyservers')
+    parser.add_argument('-n', '--count', type=int, default=100, help='Number of generated test keys.')
+    parser.add_argument('--failing', type=int, default=10, help='Number of keys the primary keyserver fails to deliver.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Delay of every keyserver answer in seconds.')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of concurrent gpg calls.')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of keys per gpg call.')
+    parser.add_argument('--db', default='lsd_benchmark', help='Temporary rethinkdb database, dropped afterwards.')
+    args = parser.parse_args(arguments)
+
+    # Connect to database
+    try:
+        conn = r.connect('localhost', 28015).repl()
+    except r.errors.ReqlDriverError:
+        sys.exit('Error: Connection to rethinkdb failed.')
+    if r.db_list().contains(args.db).run(conn):
+        r.db_drop(args.db).run(conn)
+    r.db_create(args.db).run(conn)
+
+    with tempfile.TemporaryDirectory() as source_home, tempfile.TemporaryDirectory() as target_home:
+        # Generate keys, ed25519 keys are generated fast
+        print('Generating', args.count, 'test keys')
+        source = gnupg.GPG(gnupghome=source_home)
+        for i in range(args.count):
+            source.gen_key(source.gen_key_input(key_type='EDDSA', key_curve='ed25519', name_email='test{}@example.org'.format(i),
+                    no_protection=True, expire_date='1d'))
+        keys = {key['fingerprint']: source.export_keys(key['fingerprint']) for key in source.list_keys()}
+        fingerprints = list(keys)
+
+        primary = Keyserver(keys, failing=fingerprints[:args.failing], latency=args.latency)
+        fallback = Keyserver(keys, latency=args.latency)
+        try:
+            gpg = GPG(conn, args.db, primary.start(), gnupghome=target_home, fallback_keyservers=[fallback.start()],
+                    jobs=args.jobs, batch_size=args.batch_size)
+            start = time.time()
+            gpg.recv_keys(fingerprints + ['0' * 40])
+            elapsed = time.time() - start
+        finally:
+            primary.stop()
+            fallback.stop()
+            r.db_drop(args.db).run(conn)
+
+    print()
+    print('Received {} keys in {:.1f} seconds ({:.1f} keys/s)'.format(args.count, elapsed, args.count / elapsed))
+    print('Primary keyserver requests:', dict(primary.requests))
+    print('Fallback keyserver requests:', dict(fallback.requests))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
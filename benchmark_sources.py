@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+import sys
+import time
+import argparse
+import logging
+import rethinkdb as r
+
+from LSD.sources import Sources
+from LSD.cache import Cache
+from LSD.simulator import Simulator
+
+logging.basicConfig(level=logging.WARNING)
+
+# Probe settings of every benchmarked strategy. 'warm' runs the strategy once before measuring.
+strategies = {
+    'sequential': {'probe_limit': 1, 'probe_per_host': 1},
+    'concurrent': {'probe_limit': 64, 'probe_per_host': 16},
+    'cached': {'probe_limit': 64, 'probe_per_host': 16, 'cache': True, 'warm': True},
+}
+
+def main(arguments):
+    """Fill a sources table with synthetic urls of the offline upstream simulator and
+    measure the throughput of Sources.analyze for different probing strategies.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark Sources.analyze against a local upstream simulator')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='Number of synthetic source urls.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Delay of every answer in seconds.')
+    parser.add_argument('--hops', type=int, default=2, help='Length of redirect chains.')
+    parser.add_argument('--timeout', type=float, default=2, help='Probe timeout in seconds.')
+    parser.add_argument('--db', default='lsd_benchmark', help='Temporary rethinkdb database, dropped afterwards.')
+    parser.add_argument('strategies', choices=list(strategies), nargs='*', help='Strategies to run, no arg = all')
+    args = parser.parse_args(arguments)
+
+    # Connect to database
+    try:
+        conn = r.connect('localhost', 28015).repl()
+    except r.errors.ReqlDriverError:
+        sys.exit('Error: Connection to rethinkdb failed.')
+    if r.db_list().contains(args.db).run(conn):
+        r.db_drop(args.db).run(conn)
+    r.db_create(args.db).run(conn)
+
+    simulator = Simulator(latency=args.latency, hops=args.hops, hang=args.timeout * 2)
+    simulator.start()
+    try:
+        sources = Sources(conn, args.db, force=True, probe_timeout=args.timeout, probe_ssl=simulator.client_context())
+        sources.parse(simulator.urls(args.count))
+
+        results = []
+        for name in args.strategies or list(strategies):
+            strategy = strategies[name]
+            sources.probe_limit = strategy['probe_limit']
+            sources.probe_per_host = strategy['probe_per_host']
+            sources.probe_cache = Cache() if strategy.get('cache') else None
+            if strategy.get('warm'):
+                sources.analyze()
+
+            simulator.reset()
+            start = time.time()
+            sources.analyze()
+            elapsed = time.time() - start
+            results += [(name, elapsed, dict(simulator.requests))]
+    finally:
+        simulator.stop()
+        r.db_drop(args.db).run(conn)
+
+    # Print results
+    print()
+    line = '{:<12} {:>9} {:>9} {:>9} {:>7} {:>7} {:>9}'
+    print(line.format('Strategy', 'Seconds', 'Urls/s', 'Requests', 'HEAD', 'GET', 'Failed'))
+    for name, elapsed, requests in results:
+        head = sum(count for (method, status), count in requests.items() if method == 'HEAD')
+        get = sum(count for (method, status), count in requests.items() if method == 'GET')
+        failed = sum(count for (method, status), count in requests.items() if method == 'CONNECT')
+        print(line.format(name, '{:.1f}'.format(elapsed), '{:.1f}'.format(args.count / elapsed), head + get + failed, head, get, failed))
+    print()
+    for name, elapsed, requests in results:
+        print(name + ':', ', '.join('{} {} {}'.format(method, status, count) for (method, status), count in sorted(requests.items(), key=str)))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
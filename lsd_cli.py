@@ -16,10 +16,22 @@ progressbar.streams.wrap_stderr()
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger("requests").setLevel(logging.CRITICAL)
 logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+logging.getLogger("aiohttp").setLevel(logging.CRITICAL)
 logging.getLogger("gnupg").setLevel(logging.WARNING)
 
 logging.getLogger("LSD.sources").setLevel(logging.INFO)
 logging.getLogger("LSD.archlinux").setLevel(logging.INFO)
+logging.getLogger("LSD.probe").setLevel(logging.INFO)
+
+def duration(value):
+    """Parse a duration like 90s, 30m, 2h or 1d into seconds"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if value[-1:] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid duration ' + value)
 
 def main(arguments):
     """Main entry point that parses configs and creates LSD instance."""
@@ -40,6 +52,22 @@ def main(arguments):
     parser.add_argument('-c', '--clean', choices=LSD.avail_tables, nargs='*', help='Cleanup the specified table from old entries.')
     parser.add_argument('-s', '--special', nargs='+', help='Specify special archlinux packages to analyze.')
     parser.add_argument('-u', '--update', action='store_true', help='Update PKGBUILD git and pkglist.')
+    parser.add_argument('-y', '--yes', action='store_true', help='Clean without asking for confirmation.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to parse and analyze packages.')
+    parser.add_argument('--cache-size', type=int, default=256, help='Maximum size of the PKGBUILD cache in MiB.')
+    parser.add_argument('--cache-age', type=int, default=90, help='Maximum age of PKGBUILD cache entries in days.')
+    parser.add_argument('--fast-parse', action='store_true', help='Parse simple PKGBUILDs without namcap.')
+    parser.add_argument('--batch-parse', action='store_true', help='Parse PKGBUILDs with long-lived bash workers instead of namcap.')
+    parser.add_argument('--probe-limit', type=int, default=64, help='Maximum number of concurrent connections used to analyze sources.')
+    parser.add_argument('--probe-host-limit', type=int, default=4, help='Maximum number of concurrent connections to a single host.')
+    parser.add_argument('--probe-ttl', type=float, default=7, help='Days until available source urls are revalidated.')
+    parser.add_argument('--probe-negative-ttl', type=float, default=1, help='Days until unavailable source urls are probed again.')
+    parser.add_argument('--probe-persist-hosts', action='store_true', help='Remember unreachable hosts between runs for --probe-negative-ttl days.')
+    parser.add_argument('--budget', type=duration, help='Stop analyzing sources after this time (e.g. 30m). The next run continues where it stopped.')
+    parser.add_argument('--keyserver', nargs='+', default=['hkps://hkps.pool.sks-keyservers.net', 'hkps://keyserver.ubuntu.com'],
+                        help='GPG keyservers. Keys that cannot be received are retried with the following keyservers.')
+    parser.add_argument('--import-keys', metavar='PATH', help='Import GPG keys from a directory or tarball of armored keys or an exported keyring.')
+    parser.add_argument('--compare-parsers', action='store_true', help='Compare the simple and batch PKGBUILD parsers with namcap.')
 
     args = parser.parse_args()
 
@@ -54,9 +82,13 @@ def main(arguments):
     verboseprint = print if args.verbose else lambda *a, **k: None
     debugprint = print if args.debug else lambda *a, **k: None
 
-    lsd = LSD(force=args.force, clean=args.clean, path=args.workdir, output=args.output, gnupghome=args.gnupghome)
+    lsd = LSD(force=args.force, clean=args.clean, path=args.workdir, output=args.output, gnupghome=args.gnupghome, jobs=args.jobs,
+              cache_size=args.cache_size, cache_age=args.cache_age, fast_parse=args.fast_parse,
+              batch_parse=args.batch_parse, yes=args.yes, probe_limit=args.probe_limit, probe_per_host=args.probe_host_limit,
+              probe_ttl=args.probe_ttl, probe_negative_ttl=args.probe_negative_ttl,
+              probe_persist_hosts=args.probe_persist_hosts, probe_budget=args.budget)
 
-    lsd.startdb(args.drop, keyserver='hkps://hkps.pool.sks-keyservers.net')
+    lsd.startdb(args.drop, keyserver=args.keyserver[0], fallback_keyservers=args.keyserver[1:])
 
     #if args.pkgbuild:
     #    lsd.parse(archlinux=args.pkgbuild)
@@ -66,6 +98,12 @@ def main(arguments):
         subprocess.run([os.path.join(os.path.dirname(os.path.realpath(__file__)), 'updatedb.sh'), args.workdir])
         # TODO remove, stdout=subprocess.PIPE).stdout.decode('utf-8').split('\n')
 
+    if args.import_keys:
+        lsd.import_keys(args.import_keys)
+
+    if args.compare_parsers:
+        lsd.compare_parsers()
+
     if args.parse == []:
         lsd.parse() # TODO not so complicated required?
     elif args.parse is not None:
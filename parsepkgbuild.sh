@@ -1,5 +1,25 @@
 #!/bin/bash -r
 
+# Batch mode: Read pairs of a random token line and a PKGBUILD path line from stdin.
+# Every PKGBUILD is parsed in a forked restricted subshell inside its directory, like namcap does.
+# Every record is terminated by a "\n%LSD_END% <token> <exit status>" line.
+# The token is unset before the PKGBUILD is sourced, so it cannot fake the end of a record.
+if [ "$1" = "--batch" ]; then
+	_lsd_body="$(<"${BASH_SOURCE[0]}")"
+	while IFS= read -r _lsd_token && IFS= read -r _lsd_pkgbuild; do
+		(
+			unset _lsd_token
+			cd "$(dirname -- "$_lsd_pkgbuild")" || exit 1
+			set -- "$(basename -- "$_lsd_pkgbuild")"
+			unset _lsd_pkgbuild
+			set -r
+			eval "unset _lsd_body; $_lsd_body"
+		) </dev/null
+		builtin echo -e "\n%LSD_END% $_lsd_token $?"
+	done
+	exit 0
+fi
+
 # Disable echo for the sourceing of the PKGBUILD to avoid errors
 echo() { :; }
 printf() { :; }